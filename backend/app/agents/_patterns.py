@@ -0,0 +1,30 @@
+"""
+Compiled regular expressions shared by the parsing agents.
+
+Compiled once at import, so each pattern is a single object per process
+no matter how many agent modules (or test harnesses) import it.
+"""
+
+import re
+
+# Question key (parser_agent)
+QUESTION_RE = re.compile(r'^(?:Q(?:uestion)?\s*)?(\d+)\.?\s*(.*)$', re.IGNORECASE)
+MARKS_RE = re.compile(r'(\d+)\s*marks?', re.IGNORECASE)
+
+# Subject keywords, found in one case-insensitive pass over the text
+SUBJECT_RE = re.compile(r'math|physics|chemistry|science|english|literature', re.IGNORECASE)
+
+# Evaluation output (result_agent)
+BLOCK_HEADER_RE = re.compile(r'^Q(\d+)?[^\n]*:', re.MULTILINE)
+# One sweep finds every verdict or score marker. Matches never span lines, so
+# the first line holding a verdict can be told apart from later ones.
+# The lookahead on each branch's first character lets the scan skip most
+# positions without trying all four alternatives.
+VERDICT_RE = re.compile(
+    r'(?=[(rwms])(?:'
+    r'\(Marks:?[^\S\n]*(?P<inline>\d+(?:\.\d+)?)\)'
+    r'|(?P<right>\bRight\b)'
+    r'|(?P<wrong>\bWrong\b)'
+    r'|(?:Marks Awarded|Score)[^\S\n]*[:=][^\S\n]*(?P<num>\d+(?:\.\d+)?)[^\S\n]*(?:/[^\S\n]*(?P<den>\d+(?:\.\d+)?))?)',
+    re.IGNORECASE
+)
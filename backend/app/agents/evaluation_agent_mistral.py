@@ -5,7 +5,8 @@ Evaluates structured answers against question key answers using rubric-based gra
 """
 
 import logging
-from typing import Dict, Any
+from pathlib import Path
+from typing import Dict, Any, Optional, Union
 
 logger = logging.getLogger(__name__)
 
@@ -15,33 +16,37 @@ except ImportError:
     logger.error("Ollama not installed. Install with: pip install ollama")
     ollama = None
 
-def evaluate_answers(student_answers: Dict[str, str], question_key: Dict[str, Dict[str, Any]]) -> bool:
+# Where the raw evaluation goes when the caller doesn't pass its own file
+DEFAULT_OUTPUT_FILE = Path(__file__).parent.parent.parent.parent / "llama_output.txt"
+
+def evaluate_answers(
+    student_answers: Dict[str, str],
+    question_key: Dict[str, Dict[str, Any]],
+    output_file: Optional[Union[str, Path]] = None
+) -> bool:
     """
     Evaluate each student answer against the question key using LLaMA3.
-    Saves raw LLaMA response to LamaRes folder and returns success status.
+    Saves the raw response to `output_file` (llama_output.txt at the project root
+    by default) and returns success status. Concurrent submissions must each pass
+    their own `output_file`, and hand the same path to parse_llama_results.
     """
     if not ollama:
         logger.warning("Ollama not installed, using fallback evaluation")
-        return fallback_evaluate_answers(student_answers, question_key)
+        return fallback_evaluate_answers(student_answers, question_key, output_file)
 
     try:
         # Prepare questions and answers for LLM
-        formatted_questions = []
-        formatted_answers = []
-        all_question_nums = set()
-        for q_num in question_key.keys():
-            if q_num.startswith('Q'):
-                num = q_num[1:]
-            else:
-                num = q_num
-            all_question_nums.add(num)
-        for q_num in student_answers.keys():
-            all_question_nums.add(q_num)
+        all_question_nums = {q_num[1:] if q_num.startswith('Q') else q_num for q_num in question_key}
+        all_question_nums.update(student_answers)
         sorted_questions = sorted(all_question_nums, key=lambda x: int(x) if x.isdigit() else 999)
-        for q_num in sorted_questions:
-            q_key = f"Q{q_num}"
-            if q_key in question_key:
-                q_data = question_key[q_key]
+
+        formatted_questions = [None] * len(sorted_questions)
+        formatted_answers = [None] * len(sorted_questions)
+        get_question = question_key.get
+        get_answer = student_answers.get
+        for i, q_num in enumerate(sorted_questions):
+            q_data = get_question(f"Q{q_num}")
+            if q_data is not None:
                 question = q_data.get('question', '[Question not found]')
                 ideal_answer = q_data.get('ideal_answer', None)
                 marks = q_data.get('marks', None)
@@ -50,22 +55,25 @@ def evaluate_answers(student_answers: Dict[str, str], question_key: Dict[str, Di
                     formatted += f"\nIdeal Answer: {ideal_answer}"
                 if marks:
                     formatted += f"\nMarks: {marks}"
-                formatted_questions.append(formatted)
+                formatted_questions[i] = formatted
             else:
-                formatted_questions.append(f"Q{q_num}: [Question not found in key]")
-            if q_num in student_answers:
-                formatted_answers.append(f"Q{q_num}: {student_answers[q_num]}")
+                formatted_questions[i] = f"Q{q_num}: [Question not found in key]"
+            answer = get_answer(q_num)
+            if answer is not None:
+                formatted_answers[i] = f"Q{q_num}: {answer}"
             else:
-                formatted_answers.append(f"Q{q_num}: [No answer provided]")
+                formatted_answers[i] = f"Q{q_num}: [No answer provided]"
         questions_text = "\n\n".join(formatted_questions)
         answers_text = "\n\n".join(formatted_answers)
         # Comprehensive evaluation
-        success = evaluate_all_answers_comprehensive(questions_text, answers_text)
+        success = evaluate_all_answers_comprehensive(questions_text, answers_text, output_file)
         return success
     except Exception as e:
         logger.error(f"Evaluation failed: {e}")
         return False
-def evaluate_all_answers_comprehensive(questions_text: str, answers_text: str) -> bool:
+def evaluate_all_answers_comprehensive(
+    questions_text: str, answers_text: str, output_file: Optional[Union[str, Path]] = None
+) -> bool:
     """
     Use LLaMA3 to evaluate all answers at once, save raw response to LamaRes folder.
     Returns True if successful, False otherwise.
@@ -100,10 +108,8 @@ Keep it simple and direct.
         )
         result_text = response['message']['content'].strip()
         
-        # Save raw response to project root
-        script_dir = Path(__file__).parent
-        project_root = script_dir.parent.parent.parent
-        output_file = project_root / "llama_output.txt"
+        # Save raw response to project root unless the caller picked a file
+        output_file = Path(output_file) if output_file else DEFAULT_OUTPUT_FILE
         
         logger.info(f"Evaluation agent saving llama_output.txt to: {output_file}")
         logger.info(f"Absolute path: {output_file.absolute()}")
@@ -113,19 +119,14 @@ Keep it simple and direct.
         
         logger.info(f"Saved LLaMA output to {output_file}")
         
-        # Clear Ollama cache after evaluation to free memory for result agent
+        # Unload the model after evaluation to free memory for result agent
         try:
-            import subprocess
-            logger.info("Stopping Ollama service to free memory for result agent...")
-            # Stop Ollama to free up memory
-            result = subprocess.run('ollama stop', 
-                                  shell=True, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                logger.info("Ollama service stopped successfully")
-            else:
-                logger.warning(f"Failed to stop Ollama: {result.stderr}")
+            logger.info("Unloading Mistral from Ollama to free memory for result agent...")
+            # An empty prompt with keep_alive=0 unloads the model over the HTTP API
+            ollama.generate(model='mistral', prompt='', keep_alive=0)
+            logger.info("Ollama model unloaded successfully")
         except Exception as e:
-            logger.warning(f"Could not stop Ollama service: {e}")
+            logger.warning(f"Could not unload Ollama model: {e}")
         
         return True
     except Exception as e:
@@ -133,7 +134,11 @@ Keep it simple and direct.
         return False
 
 
-def fallback_evaluate_answers(student_answers: Dict[str, str], question_key: Dict[str, Dict[str, Any]]) -> bool:
+def fallback_evaluate_answers(
+    student_answers: Dict[str, str],
+    question_key: Dict[str, Dict[str, Any]],
+    output_file: Optional[Union[str, Path]] = None
+) -> bool:
     """
     Simple fallback evaluation when Ollama is not available or fails.
     Saves fallback results to LamaRes folder.
@@ -143,15 +148,8 @@ def fallback_evaluate_answers(student_answers: Dict[str, str], question_key: Dic
     
     evaluations = {}
     # Get all question numbers
-    all_question_nums = set()
-    for q_num in question_key.keys():
-        if q_num.startswith('Q'):
-            num = q_num[1:]
-        else:
-            num = q_num
-        all_question_nums.add(num)
-    for q_num in student_answers.keys():
-        all_question_nums.add(q_num)
+    all_question_nums = {q_num[1:] if q_num.startswith('Q') else q_num for q_num in question_key}
+    all_question_nums.update(student_answers)
     for q_num in all_question_nums:
         q_key = f"Q{q_num}"
         student_answer = student_answers.get(q_num, "")
@@ -183,10 +181,8 @@ def fallback_evaluate_answers(student_answers: Dict[str, str], question_key: Dic
     total_score = sum(v.get('score', 0) for v in evaluations.values())
     max_score = sum(q.get('marks', 0) for q in question_key.values() if isinstance(q, dict) and 'marks' in q)
     
-    # Save to project root
-    script_dir = Path(__file__).parent
-    project_root = script_dir.parent.parent.parent
-    output_file = project_root / "llama_output.txt"
+    # Save to project root unless the caller picked a file
+    output_file = Path(output_file) if output_file else DEFAULT_OUTPUT_FILE
     fallback_data = {
         "evaluations": evaluations,
         "total_score": total_score,
@@ -5,26 +5,110 @@ Error-proof with retries, logging, and fallbacks.
 """
 
 import os
+import re
 import sys
+import io
+import importlib.util
 import json
+import base64
+import asyncio
+import contextlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
+# Answer label such as a), b) or 01), 06) anywhere on a line; group 2 is the
+# text after the label. Compiled once and scanned over the whole OCR buffer.
+# ASCII-only so labels can index the lookup table below.
+_ANSWER_LABEL_RE = re.compile(r"^.*?([a-z]|\d+)\)(.*)$", re.IGNORECASE | re.MULTILINE | re.ASCII)
+
+# Alphabetical position of a lowercase label letter (a -> 1 ... z -> 26), 0 for digits
+_LETTER_POSITION = bytes(
+    code - ord("a") + 1 if ord("a") <= code <= ord("z") else 0 for code in range(256)
+)
+
+# Subjects that get the math-aware prompt ("math" also covers "mathematics")
+_SCIENCE_SUBJECT_RE = re.compile(r"math|physics|chemistry|science", re.IGNORECASE)
+
+SCIENCE_OCR_PROMPT = "Transcribe all visible text from this image exactly as it appears, including mathematical symbols and equations. Preserve layout and structure."
+GENERAL_OCR_PROMPT = "Transcribe all visible text from this image exactly as it appears. Preserve layout and structure."
+
 try:
     import torch
-    from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, Qwen2VLProcessor
+    import numpy as np
+    from transformers import Qwen2VLForConditionalGeneration, Qwen2VLProcessor, BitsAndBytesConfig
     from PIL import Image
 except ImportError as e:
     logger.error(f"Import failed: {e}")
     sys.exit(1)
 
+try:
+    import httpx
+except ImportError:
+    logger.warning("httpx not installed. Remote OCR server disabled.")
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import cv2
+except ImportError:
+    logger.warning("OpenCV not installed. OCR margin cropping disabled.")
+    cv2 = None
+
+# Blank page margins are cropped before OCR so the model spends no visual tokens on them
+OCR_CROP_MARGINS = os.getenv("OCR_CROP_MARGINS", "1") == "1"
+
+def _json_line(record: Dict) -> bytes:
+    """One UTF-8 JSON line; orjson when installed, stdlib json with the same output otherwise."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+# Decode budget per page: ink pixels / OCR_PIXELS_PER_TOKEN, clamped to
+# [OCR_MIN_NEW_TOKENS, OCR_MAX_NEW_TOKENS]. A page that stops at EOS is unaffected;
+# the cap bounds runaway repetition on sparse pages. 0 always allows the maximum.
+OCR_MAX_NEW_TOKENS = int(os.getenv("OCR_MAX_NEW_TOKENS", "2048"))
+OCR_MIN_NEW_TOKENS = 256
+OCR_PIXELS_PER_TOKEN = int(os.getenv("OCR_PIXELS_PER_TOKEN", "100"))
+
 
 class OCREngine:
-    def __init__(self, model_name: str = os.getenv("OCR_MODEL", "Qwen/Qwen2-VL-2B-Instruct")):
-        """Initialize the OCR engine with model and device setup."""
+    def __init__(
+        self,
+        model_name: str = os.getenv("OCR_MODEL", "Qwen/Qwen2-VL-2B-Instruct"),
+        quant: str = os.getenv("OCR_QUANT", "fp16"),
+        server_url: Optional[str] = os.getenv("OCR_SERVER_URL"),
+        attn_implementation: str = os.getenv("OCR_ATTN", "sdpa"),
+        compile_model: bool = os.getenv("OCR_COMPILE", "0") == "1",
+    ):
+        """
+        Initialize the OCR engine with model and device setup.
+        `quant` selects the weight format: fp16 (default; bf16 on Ampere+), int8 or int4 (bitsandbytes),
+        or awq (Qwen's prequantized int4 "<model>-AWQ" checkpoint; needs autoawq).
+        If `server_url` points at an OpenAI-compatible server (e.g. `vllm serve`),
+        no local model is loaded and pages are sent to that server instead.
+        `attn_implementation` is passed to transformers ("sdpa" or "flash_attention_2";
+        the latter falls back to SDPA when flash-attn isn't installed).
+        `compile_model` wraps the forward pass in torch.compile with a static KV cache.
+        """
+        self.model_name = model_name
+        self.server_url = server_url.rstrip("/") if server_url else None
+
+        if self.server_url:
+            if not httpx:
+                raise RuntimeError("httpx required for remote OCR server")
+            self.model = None
+            logger.info(f"Using remote OCR server: {self.server_url}")
+            return
+
         if not torch.cuda.is_available():
             raise RuntimeError(
                 "CUDA GPU is required for OCR processing. Please ensure a CUDA-compatible GPU is available and PyTorch is installed with CUDA support."
@@ -32,96 +116,423 @@ class OCREngine:
 
         self.device = torch.device("cuda")
         logger.info(f"Using GPU device: {self.device}")
+        # Let any FP32 matmuls left in the vision tower use TF32 tensor cores
+        torch.set_float32_matmul_precision("high")
+
+        # BF16 has FP16's footprint and tensor-core speed but FP32's range;
+        # it needs Ampere (compute capability 8.x) or newer
+        dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+
+        if attn_implementation == "flash_attention_2" and importlib.util.find_spec("flash_attn") is None:
+            logger.warning("flash-attn not installed, falling back to SDPA attention")
+            attn_implementation = "sdpa"
+
+        load_kwargs = {
+            "torch_dtype": dtype,
+            "device_map": "auto",
+            "attn_implementation": attn_implementation,
+            # Stream safetensors shards straight to the GPU instead of building
+            # the full state dict in host RAM first
+            "low_cpu_mem_usage": True,
+            "use_safetensors": True,
+        }
+        quant = quant.lower()
+        if quant == "int8":
+            load_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+        elif quant == "int4":
+            load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_quant_type="nf4",
+            )
+        elif quant == "awq":
+            # Weights come quantized in the checkpoint; AWQ kernels run in FP16
+            if not model_name.upper().endswith("-AWQ"):
+                model_name = f"{model_name}-AWQ"
+                self.model_name = model_name
+            dtype = torch.float16
+            load_kwargs["torch_dtype"] = dtype
+        elif quant != "fp16":
+            logger.warning(f"Unknown OCR_QUANT '{quant}', falling back to fp16")
+            quant = "fp16"
+
+        # Rendered chat templates keyed by prompt text
+        self._chat_text_cache: Dict[str, str] = {}
+        # The fast tokenizer can't be entered from two threads at once, and the
+        # prefetch thread runs the processor while the caller decodes
+        self._processor_lock = threading.Lock()
+        # Becomes a Lock once the model is compiled: the static KV cache lives on the
+        # model and each generate resets it, so compiled generates must not overlap
+        self._generate_lock = contextlib.nullcontext()
 
         try:
-            self.model = Qwen2VLForConditionalGeneration.from_pretrained(
-                model_name, torch_dtype=torch.float16, device_map="auto"
-            )
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.processor = Qwen2VLProcessor.from_pretrained(model_name, use_fast=False)
-            logger.info("OCR model loaded successfully on GPU.")
+            self.model = Qwen2VLForConditionalGeneration.from_pretrained(model_name, **load_kwargs)
+            self.model.eval()
+            self.model.generation_config.use_cache = True
+            self.processor = Qwen2VLProcessor.from_pretrained(model_name, use_fast=True)
+            # Decoder-only batching needs left padding so prompts end together
+            self.processor.tokenizer.padding_side = "left"
+            logger.info(f"OCR model loaded successfully on GPU ({quant} weights, {dtype}, {attn_implementation} attention).")
         except Exception as e:
             logger.error(f"Model loading failed: {e}")
             raise RuntimeError(f"Failed to load OCR model on GPU: {e}")
 
-    def ocr_handwriting(self, image_path: str, subject: str = "general") -> str:
-        """Perform OCR on a single image with subject-aware prompt."""
+        if compile_model:
+            self._compile_model()
+
+    def _compile_model(self):
+        """Compile the forward pass against a static KV cache and warm it up once."""
+        eager_forward = self.model.forward
         try:
-            if not Path(image_path).exists():
-                raise FileNotFoundError(f"Image not found: {image_path}")
+            self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+            self._generate_lock = threading.Lock()
+
+            # First call pays the compile cost; do it here instead of on a real page
+            warmup_image = Image.new("RGB", (448, 448), "white")
+            # Call generate directly; ocr_batch returns "" on failure, which would hide a broken compile
+            inputs = self._prepare_batch([warmup_image], "general")["inputs"].to(self.device)
+            with torch.inference_mode():
+                self.model.generate(
+                    **inputs, max_new_tokens=8, do_sample=False, use_cache=True,
+                    pad_token_id=self.processor.tokenizer.pad_token_id
+                )
+            logger.info("OCR model compiled and warmed up.")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, continuing in eager mode: {e}")
+            self.model.forward = eager_forward
+            self.model.generation_config.cache_implementation = None
+            self._generate_lock = contextlib.nullcontext()
 
-            image = Image.open(image_path).convert("RGB")
+    def ocr_handwriting(self, image: Union[str, np.ndarray, Image.Image], subject: str = "general") -> str:
+        """
+        Perform OCR on a single image with subject-aware prompt.
+        `image` may be a file path, a BGR ndarray (e.g. from align_images) or a PIL image;
+        in-memory images skip the disk round trip.
+        """
+        try:
+            image, max_new_tokens = self._prepare_page(self._load_image(image))
             prompt = self._get_subject_prompt(subject)
 
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image", "image": image},
-                    ],
-                }
-            ]
+            if self.server_url:
+                return asyncio.run(self._ocr_remote_many([image], prompt))[0]
 
-            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            inputs = self.processor(text=text, images=image, return_tensors="pt").to(self.device)
+            with self._processor_lock:
+                text = self._get_chat_text(prompt)
+                inputs = self.processor(text=text, images=image, return_tensors="pt")
+            inputs = inputs.to(self.device)
 
-            with torch.no_grad():
+            with self._generate_lock, torch.inference_mode():
                 generated_ids = self.model.generate(
-                    **inputs, max_new_tokens=2048, do_sample=False
+                    **inputs, max_new_tokens=max_new_tokens, do_sample=False, use_cache=True,
+                    pad_token_id=self.processor.tokenizer.pad_token_id
                 )
 
             generated_ids_trimmed = [
                 out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
             ]
 
-            output_text = self.processor.batch_decode(
-                generated_ids_trimmed, skip_special_tokens=True
-            )[0]
+            with self._processor_lock:
+                output_text = self.processor.batch_decode(
+                    generated_ids_trimmed, skip_special_tokens=True
+                )[0]
 
             return output_text.strip()
 
         except Exception as e:
-            logger.error(f"OCR failed for {image_path}: {e}")
+            logger.error(f"OCR failed for {image if isinstance(image, str) else 'in-memory image'}: {e}")
             return ""
 
+    @staticmethod
+    def _load_image(image: Union[str, np.ndarray, Image.Image]) -> Image.Image:
+        """Normalize a path, BGR ndarray or PIL image to an RGB PIL image."""
+        if isinstance(image, Image.Image):
+            return image.convert("RGB")
+        if isinstance(image, np.ndarray):
+            # OpenCV arrays are BGR; flip the channel axis for PIL
+            return Image.fromarray(image[..., ::-1] if image.ndim == 3 else image).convert("RGB")
+
+        if not Path(image).exists():
+            raise FileNotFoundError(f"Image not found: {image}")
+        return Image.open(image).convert("RGB")
+
+    @staticmethod
+    def _prepare_page(image: Image.Image) -> Tuple[Image.Image, int]:
+        """
+        Crop blank margins around the ink (Otsu threshold), keeping a small border,
+        and size the page's decode budget from how much ink it has.
+        Pages that are mostly content, or have no ink at all, are not cropped.
+        Returns (image, max_new_tokens).
+        """
+        if cv2 is None or (not OCR_CROP_MARGINS and OCR_PIXELS_PER_TOKEN <= 0):
+            return image, OCR_MAX_NEW_TOKENS
+
+        gray = np.asarray(image.convert("L"))
+        _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+        max_new_tokens = OCR_MAX_NEW_TOKENS
+        if OCR_PIXELS_PER_TOKEN > 0:
+            estimate = cv2.countNonZero(ink) // OCR_PIXELS_PER_TOKEN
+            max_new_tokens = min(max(estimate, OCR_MIN_NEW_TOKENS), OCR_MAX_NEW_TOKENS)
+
+        if not OCR_CROP_MARGINS:
+            return image, max_new_tokens
+        rows = np.flatnonzero(ink.any(axis=1))
+        cols = np.flatnonzero(ink.any(axis=0))
+        if rows.size == 0:
+            return image, max_new_tokens
+
+        width, height = image.size
+        pad = max(8, max(width, height) // 100)
+        left, right = max(int(cols[0]) - pad, 0), min(int(cols[-1]) + pad + 1, width)
+        top, bottom = max(int(rows[0]) - pad, 0), min(int(rows[-1]) + pad + 1, height)
+        if (right - left) * (bottom - top) > 0.9 * width * height:
+            return image, max_new_tokens
+        return image.crop((left, top, right, bottom)), max_new_tokens
+
+    def _prepare_batch(self, images: List[Image.Image], subject: str) -> Dict[str, Any]:
+        """
+        CPU-side work for one batched generate call: crop the pages, size the decode
+        budget and run the processor. Returns {"images", "max_new_tokens", "inputs"};
+        "inputs" stays on the CPU and is None when OCR goes to a remote server.
+        """
+        pages = [self._prepare_page(image) for image in images]
+        images = [image for image, _ in pages]
+        # The batch decodes until its longest page is done
+        batch = {"images": images, "max_new_tokens": max(budget for _, budget in pages), "inputs": None}
+        if self.server_url:
+            return batch
+
+        with self._processor_lock:
+            # The chat template is identical for every page; the processor
+            # expands the image placeholder per image.
+            text = self._get_chat_text(self._get_subject_prompt(subject))
+            batch["inputs"] = self.processor(
+                text=[text] * len(images), images=images, padding=True, return_tensors="pt"
+            )
+        return batch
+
+    def ocr_batch(
+        self, images: List[Image.Image], subject: str = "general",
+        batch: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        """
+        Perform OCR on several images with a single batched generate call.
+        `batch` is the images' `_prepare_batch` result, when it was already built.
+        """
+        try:
+            if batch is None:
+                batch = self._prepare_batch(images, subject)
+            images = batch["images"]
+
+            if self.server_url:
+                return asyncio.run(self._ocr_remote_many(images, self._get_subject_prompt(subject)))
+
+            inputs = batch["inputs"].to(self.device)
+
+            with self._generate_lock, torch.inference_mode():
+                generated_ids = self.model.generate(
+                    **inputs, max_new_tokens=batch["max_new_tokens"], do_sample=False, use_cache=True,
+                    pad_token_id=self.processor.tokenizer.pad_token_id
+                )
+
+            generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+
+            with self._processor_lock:
+                output_texts = self.processor.batch_decode(
+                    generated_ids_trimmed, skip_special_tokens=True
+                )
+
+            return [output_text.strip() for output_text in output_texts]
+
+        except torch.cuda.OutOfMemoryError as e:
+            if len(images) == 1:
+                logger.error(f"OCR ran out of GPU memory on a single page: {e}")
+                return [""]
+            # Halve the batch until it fits instead of losing every page in it
+            logger.warning(f"OCR batch of {len(images)} pages ran out of GPU memory. Splitting it.")
+            torch.cuda.empty_cache()
+            half = len(images) // 2
+            return self.ocr_batch(images[:half], subject) + self.ocr_batch(images[half:], subject)
+        except Exception as e:
+            logger.error(f"Batched OCR failed for {len(images)} images: {e}")
+            return [""] * len(images)
+
+    def _get_chat_text(self, prompt: str) -> str:
+        """
+        Return the chat-templated text for a prompt, rendering each prompt once.
+        Only the image placeholder varies per page, and the processor fills it in.
+        """
+        text = self._chat_text_cache.get(prompt)
+        if text is None:
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image"},
+                    ],
+                }
+            ]
+            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            self._chat_text_cache[prompt] = text
+        return text
+
+    async def _ocr_remote_many(self, images: List[Image.Image], prompt: str) -> List[str]:
+        """Send all images concurrently so the server can batch them."""
+        async with httpx.AsyncClient(base_url=self.server_url, timeout=300) as client:
+            return await asyncio.gather(
+                *(self._ocr_remote(client, image, prompt) for image in images)
+            )
+
+    async def _ocr_remote(self, client: "httpx.AsyncClient", image: Image.Image, prompt: str) -> str:
+        """OCR one image through the OpenAI-compatible chat completions endpoint."""
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=95)
+        image_b64 = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+        payload = {
+            "model": self.model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
+                    ],
+                }
+            ],
+            "max_tokens": OCR_MAX_NEW_TOKENS,
+            "temperature": 0,
+        }
+
+        response = await client.post("/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"].strip()
+
     def _get_subject_prompt(self, subject: str) -> str:
         """Selects simple prompt template based on subject context."""
-        subject_lower = subject.lower()
-
         # Math/Science subject prompt (preserves equations and layout)
-        if any(
-            keyword in subject_lower
-            for keyword in ["math", "mathematics", "physics", "chemistry", "science"]
-        ):
-            return "Transcribe all visible text from this image exactly as it appears, including mathematical symbols and equations. Preserve layout and structure."
+        if _SCIENCE_SUBJECT_RE.search(subject):
+            return SCIENCE_OCR_PROMPT
 
         # Default generic subject prompt
-        return "Transcribe all visible text from this image exactly as it appears. Preserve layout and structure."
+        return GENERAL_OCR_PROMPT
 
-    def process_folder(self, folder_path: str, subject: str = "general") -> Dict[str, Dict[str, str]]:
-        """Process all supported images in a folder and return structured OCR outputs."""
+    def process_folder(
+        self, folder_path: str, subject: str = "general", batch_size: int = 4
+    ) -> Dict[str, Dict[str, str]]:
+        """
+        Process all supported images in a folder and return structured OCR outputs.
+        Use iter_folder or save_folder_results for large folders so results don't
+        all stay in memory.
+        """
         try:
-            results = {}
-            folder = Path(folder_path)
-
-            if not folder.exists():
-                raise FileNotFoundError(f"Folder not found: {folder_path}")
-
-            for file_path in folder.iterdir():
-                if file_path.suffix.lower() in {".jpg", ".jpeg", ".png"}:
-                    ocr_text = self.ocr_handwriting(str(file_path), subject)
-                    structured = self.parse_exam_output(ocr_text)
-                    results[file_path.name] = {
-                        "raw_ocr": ocr_text,
-                        "structured": structured,
-                    }
-
-            return results
+            return dict(self.iter_folder(folder_path, subject, batch_size))
         except Exception as e:
             logger.error(f"Folder processing failed: {e}")
             return {}
 
+    def iter_folder(
+        self, folder_path: str, subject: str = "general", batch_size: int = 4
+    ) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """
+        Yield (file name, {"raw_ocr", "structured"}) for each supported image in a folder,
+        `batch_size` pages per generate call.
+        """
+        folder = Path(folder_path)
+        if not folder.exists():
+            raise FileNotFoundError(f"Folder not found: {folder_path}")
+
+        file_paths = [
+            file_path for file_path in folder.iterdir()
+            if file_path.suffix.lower() in {".jpg", ".jpeg", ".png"}
+        ]
+
+        for file_path, ocr_text in self._iter_ocr(file_paths, subject, batch_size):
+            yield file_path.name, {
+                "raw_ocr": ocr_text,
+                "structured": self.parse_exam_output(ocr_text),
+            }
+
+    def ocr_handwriting_batch(
+        self, images: Sequence[Union[str, Path, np.ndarray, Image.Image]],
+        subject: str = "general", batch_size: int = 4
+    ) -> List[str]:
+        """
+        OCR several pages (paths, BGR ndarrays or PIL images) with one generate call
+        per `batch_size` pages instead of one per page. Texts are returned in input order.
+        """
+        return [ocr_text for _, ocr_text in self._iter_ocr(list(images), subject, batch_size)]
+
+    def _iter_ocr(self, pages: List, subject: str, batch_size: int) -> Iterator[Tuple]:
+        """
+        Yield (page, OCR text) in order, sending pages to the model in chunks of
+        `batch_size` to bound VRAM use; the next chunk is loaded and run through the
+        processor on a worker thread while the current one generates.
+        """
+        if self.server_url:
+            # The server schedules its own batches; submit everything at once
+            batch_size = max(len(pages), 1)
+
+        chunks = [pages[start:start + batch_size] for start in range(0, len(pages), batch_size)]
+        if not chunks:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            pending = prefetch.submit(self._load_and_prepare, chunks[0], subject)
+            for index, batch_pages in enumerate(chunks):
+                images, batch = pending.result()
+                if index + 1 < len(chunks):
+                    pending = prefetch.submit(self._load_and_prepare, chunks[index + 1], subject)
+
+                # Pages that couldn't be loaded get "" instead of ending the run
+                loaded = [image for image in images if image is not None]
+                texts = iter(self.ocr_batch(loaded, subject, batch) if loaded else [])
+                for page, image in zip(batch_pages, images):
+                    yield page, next(texts) if image is not None else ""
+
+    def save_folder_results(
+        self, folder_path: str, output_path: str, subject: str = "general", batch_size: int = 4
+    ) -> int:
+        """
+        OCR a folder and append one JSON line per page to `output_path` as pages finish,
+        so memory stays bounded by one batch. Returns the number of pages written.
+        """
+        count = 0
+        with open(output_path, "wb") as output:
+            for name, data in self.iter_folder(folder_path, subject, batch_size):
+                output.write(_json_line({"file": name, **data}))
+                count += 1
+        logger.info(f"Wrote OCR results for {count} pages to {output_path}")
+        return count
+
+    @staticmethod
+    def _load_batch(pages: List) -> List[Optional[Image.Image]]:
+        """Load each page, logging and returning None for any that can't be read."""
+        images = []
+        for page in pages:
+            try:
+                images.append(OCREngine._load_image(page))
+            except Exception as e:
+                logger.error(f"Failed to load {page if isinstance(page, (str, Path)) else 'in-memory image'}: {e}")
+                images.append(None)
+        return images
+
+    def _load_and_prepare(
+        self, pages: List, subject: str
+    ) -> Tuple[List[Optional[Image.Image]], Optional[Dict[str, Any]]]:
+        images = self._load_batch(pages)
+        loaded = [image for image in images if image is not None]
+        if not loaded:
+            return images, None
+        try:
+            return images, self._prepare_batch(loaded, subject)
+        except Exception as e:
+            # ocr_batch prepares the pages again and reports the failure for them
+            logger.warning(f"Preparing OCR batch of {len(loaded)} pages failed: {e}")
+            return images, None
+
     def parse_exam_output(self, ocr_text: str) -> Dict[str, str]:
         """
         Parse raw OCR text into structured exam Q&A pairs with document-level memory.
@@ -130,57 +541,63 @@ class OCREngine:
         Returns a dict mapping question numbers to extracted answers.
         """
         structured_answers = {}
-        lines = ocr_text.split("\n")
-        current_question = None
-        current_answer = []
         question_counter = 0  # Track sequential question numbering
 
-        import re
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-
-            # Match a), b), c), etc. OR 01), 02), 06), etc. format (more flexible)
-            question_match = re.match(
-                r".*?([a-z]|\d+)\)\s*(.*)$", line, re.IGNORECASE
-            )
-
-            if question_match:
-                # Save previous question if present
-                if current_question is not None:
-                    structured_answers[current_question] = "\n".join(current_answer).strip()
-
-                # Extract the label (letter or number)
-                label = question_match.group(1).lower()
-                remaining_text = question_match.group(2).strip()
-
-                # Determine the question number based on document flow
-                if label.isalpha():
-                    # Letter format: use alphabetical position
-                    expected_num = ord(label) - ord('a') + 1
-                    question_counter = max(question_counter, expected_num)
-                    question_number = str(expected_num)
+        matches = list(_ANSWER_LABEL_RE.finditer(ocr_text))
+        for index, question_match in enumerate(matches):
+            # Answer body runs until the next label (or the end of the text);
+            # body lines are stripped and filtered with C-level map/filter
+            body_end = matches[index + 1].start() if index + 1 < len(matches) else len(ocr_text)
+            body_lines = ocr_text[question_match.end():body_end].split("\n")
+
+            # Extract the label (letter or number)
+            label = question_match.group(1).lower()
+            remaining_text = question_match.group(2).strip()
+
+            # Determine the question number based on document flow
+            expected_num = _LETTER_POSITION[ord(label[0])]
+            if expected_num:
+                # Letter format: use alphabetical position
+                question_counter = max(question_counter, expected_num)
+                question_number = str(expected_num)
+            else:
+                # Number format: could be OCR misread or actual numbering
+                # If it's a small number that matches our counter + 1, use it
+                num_val = int(label.lstrip('0') or '0')
+                if num_val == question_counter + 1:
+                    question_number = str(num_val)
+                    question_counter = num_val
                 else:
-                    # Number format: could be OCR misread or actual numbering
-                    # If it's a small number that matches our counter + 1, use it
-                    num_val = int(label.lstrip('0') or '0')
-                    if num_val == question_counter + 1:
-                        question_number = str(num_val)
-                        question_counter = num_val
-                    else:
-                        # Assume it's the next sequential question
-                        question_counter += 1
-                        question_number = str(question_counter)
-
-                current_question = question_number
-                current_answer = [remaining_text] if remaining_text else []
-
-            elif current_question is not None:
-                current_answer.append(line)
-
-        if current_question is not None:
-            structured_answers[current_question] = "\n".join(current_answer).strip()
+                    # Assume it's the next sequential question
+                    question_counter += 1
+                    question_number = str(question_counter)
+
+            answer_lines = [remaining_text] if remaining_text else []
+            answer_lines.extend(filter(None, map(str.strip, body_lines)))
+            structured_answers[question_number] = "\n".join(answer_lines)
 
         return structured_answers
 
+
+_engine: Optional[OCREngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> OCREngine:
+    """Return the process-wide OCR engine, loading the model on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = OCREngine()
+        return _engine
+
+
+def release_engine():
+    """Drop the shared OCR engine and free its GPU memory."""
+    global _engine
+    with _engine_lock:
+        _engine = None
+    import gc
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
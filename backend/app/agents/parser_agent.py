@@ -4,24 +4,65 @@ Parser Agent: Extract and structure question data from teacher-uploaded files
 Parses PDF/DOCX question keys to extract questions, ideal answers, and marks.
 """
 
-import re
+import io
+import os
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
-logger = logging.getLogger(__name__)
+from ._patterns import QUESTION_RE, MARKS_RE, SUBJECT_RE
 
-try:
-    import pdfplumber
-except ImportError:
-    logger.warning("pdfplumber not installed. PDF parsing disabled.")
-    pdfplumber = None
+logger = logging.getLogger(__name__)
 
-try:
-    from docx import Document
-except ImportError:
-    logger.warning("python-docx not installed. DOCX parsing disabled.")
-    Document = None
+# Keyword -> subject, in detection priority order
+SUBJECT_PRIORITY = (
+    ("math", "Mathematics"),
+    ("physics", "Physics"),
+    ("chemistry", "Chemistry"),
+    ("science", "Science"),
+    ("english", "English"),
+    ("literature", "English"),
+)
+
+# PDFs with at least this many pages are extracted in parallel worker processes
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+PDF_PAGES_PER_WORKER = 4
+
+# Clark-notation WordprocessingML tags (what docx.oxml.ns.qn("w:...") returns)
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = _W + "p"
+_W_R = _W + "r"
+_W_HYPERLINK = _W + "hyperlink"
+# Run children that carry text, the same set python-docx's Run.text reads
+_W_RUN_TEXT_TAGS = frozenset(_W + tag for tag in ("br", "cr", "noBreakHyphen", "ptab", "t", "tab"))
+
+# pdfplumber (via pdfminer.six) and python-docx are slow to import, so they are
+# loaded on first use. None = not tried yet, False = not installed.
+_pdfplumber = None
+_Document = None
+
+def _get_pdfplumber():
+    global _pdfplumber
+    if _pdfplumber is None:
+        try:
+            import pdfplumber as _pdfplumber
+        except ImportError:
+            logger.warning("pdfplumber not installed. PDF parsing disabled.")
+            _pdfplumber = False
+    return _pdfplumber
+
+def _get_document():
+    global _Document
+    if _Document is None:
+        try:
+            from docx import Document as _Document
+        except ImportError:
+            logger.warning("python-docx not installed. DOCX parsing disabled.")
+            _Document = False
+    return _Document
 
 def parse_question_key(file_path: str) -> Dict[str, Any]:
     """
@@ -44,53 +85,100 @@ def parse_question_key(file_path: str) -> Dict[str, Any]:
         logger.error(f"Question key parsing failed for {file_path}: {e}")
         return {"subject": "general", "questions": {}}
 
+def _extract_pdf_pages(pdf_path: str, page_numbers: Optional[List[int]] = None) -> List[str]:
+    """Extract the text of the given 1-based pages (all pages if None)."""
+    pdfplumber = _get_pdfplumber()
+    texts = []
+    with pdfplumber.open(pdf_path, pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            # extract_text() returns None for image-only pages
+            texts.append(page.extract_text() or "")
+            # Drop the page's cached layout objects so memory stays flat on long PDFs
+            page.close()
+    return texts
+
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from PDF using pdfplumber."""
+    pdfplumber = _get_pdfplumber()
     if not pdfplumber:
         raise ImportError("pdfplumber required for PDF parsing")
 
-    text = ""
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() + "\n"
-    return text
+        num_pages = len(pdf.pages)
+
+    workers = min(os.cpu_count() or 1, num_pages // PDF_PAGES_PER_WORKER)
+    if num_pages < PDF_PARALLEL_MIN_PAGES or workers < 2:
+        texts = _extract_pdf_pages(pdf_path)
+    else:
+        # pdfminer layout analysis is pure Python, so spread contiguous page
+        # ranges over worker processes rather than threads. Spawn them fresh:
+        # forking this multithreaded process (OCR, log listener) can deadlock the child
+        chunk = -(-num_pages // workers)
+        ranges = [list(range(start + 1, min(start + chunk, num_pages) + 1))
+                  for start in range(0, num_pages, chunk)]
+        with ProcessPoolExecutor(
+            max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            texts = [text for part in executor.map(_extract_pdf_pages, repeat(pdf_path), ranges)
+                     for text in part]
+
+    buf = io.StringIO()
+    for text in texts:
+        buf.write(text)
+        buf.write("\n")
+    return buf.getvalue()
+
+def _docx_paragraph_text(p) -> str:
+    """
+    Same text as python-docx's Paragraph.text, read by walking the <w:p> element's
+    runs directly instead of running its per-paragraph and per-run XPath queries.
+    """
+    pieces = []
+    for child in p:
+        if child.tag == _W_R:
+            runs = (child,)
+        elif child.tag == _W_HYPERLINK:
+            runs = child.iterchildren(_W_R)
+        else:
+            continue
+        for run in runs:
+            for element in run:
+                if element.tag in _W_RUN_TEXT_TAGS:
+                    # python-docx maps tabs/breaks/hyphens to text in __str__
+                    pieces.append(str(element))
+    return "".join(pieces)
 
 def extract_text_from_docx(docx_path: str) -> str:
     """Extract text from DOCX using python-docx."""
+    Document = _get_document()
     if not Document:
         raise ImportError("python-docx required for DOCX parsing")
 
     doc = Document(docx_path)
-    text = ""
-    for para in doc.paragraphs:
-        text += para.text + "\n"
-    return text
+    parts = [_docx_paragraph_text(p) for p in doc.element.body.iterchildren(_W_P)]
+    return "\n".join(parts) + "\n" if parts else ""
 
 def parse_question_text(text: str) -> Dict[str, Any]:
     """
     Parse the extracted text to identify questions, answers, and marks.
     """
-    questions = {}
+    question_items = []
     lines = text.split('\n')
     current_question = None
     current_data = {}
     subject = "general"  # default
 
     # Try to detect subject from text
-    text_lower = text.lower()
-    if "math" in text_lower or "mathematics" in text_lower:
-        subject = "Mathematics"
-    elif "physics" in text_lower:
-        subject = "Physics"
-    elif "chemistry" in text_lower:
-        subject = "Chemistry"
-    elif "science" in text_lower:
-        subject = "Science"
-    elif "english" in text_lower or "literature" in text_lower:
-        subject = "English"
-
-    question_pattern = re.compile(r'^(?:Q(?:uestion)?\s*)?(\d+)\.?\s*(.*)$', re.IGNORECASE)
-    marks_pattern = re.compile(r'(\d+)\s*marks?', re.IGNORECASE)
+    found_keywords = set()
+    for keyword_match in SUBJECT_RE.finditer(text):
+        found_keywords.add(keyword_match.group().lower())
+        if SUBJECT_PRIORITY[0][0] in found_keywords:
+            # Highest-priority subject, nothing later can change the result
+            break
+    for keyword, subject_name in SUBJECT_PRIORITY:
+        if keyword in found_keywords:
+            subject = subject_name
+            break
 
     for line in lines:
         line = line.strip()
@@ -98,11 +186,11 @@ def parse_question_text(text: str) -> Dict[str, Any]:
             continue
 
         # Check for question start
-        match = question_pattern.match(line)
+        match = QUESTION_RE.match(line)
         if match:
             # Save previous question
             if current_question and current_data:
-                questions[current_question] = current_data
+                question_items.append((current_question, current_data))
 
             # Start new question
             current_question = f"Q{match.group(1)}"
@@ -113,7 +201,7 @@ def parse_question_text(text: str) -> Dict[str, Any]:
             }
         elif current_question:
             # Check for marks
-            marks_match = marks_pattern.search(line)
+            marks_match = MARKS_RE.search(line)
             if marks_match:
                 current_data["marks"] = int(marks_match.group(1))
             else:
@@ -125,7 +213,8 @@ def parse_question_text(text: str) -> Dict[str, Any]:
 
     # Save last question
     if current_question and current_data:
-        questions[current_question] = current_data
+        question_items.append((current_question, current_data))
+    questions = dict(question_items)
 
     logger.info(f"Parsed subject: {subject}, {len(questions)} questions from question key")
     return {"subject": subject, "questions": questions}
\ No newline at end of file
@@ -5,11 +5,18 @@ Reads the raw LLaMA response from llama_output.txt and uses Mistral LLM to extra
 structured evaluation data with detailed feedback, strengths, and improvements.
 """
 
+import copy
+import hashlib
 import logging
+import os
 import json
-import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple, Union
+
+from ._patterns import BLOCK_HEADER_RE, VERDICT_RE
 
 try:
     import ollama
@@ -20,170 +27,297 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-def parse_llama_results() -> Dict[str, Any]:
+# Within a line an inline mark beats Right, which beats Wrong
+VERDICT_PRIORITY = {"inline": 0, "right": 1, "wrong": 2}
+
+# Default strengths/improvements text, indexed by is_correct
+_CORRECT = ("", "Correct answer")
+_SUBMITTED = ("", "Answer submitted")
+_IMPROVE = ("Review the concept", "")
+
+# Written by the evaluation agent at the project root
+LLAMA_OUTPUT_FILE = Path(__file__).parent.parent.parent.parent / "llama_output.txt"
+
+# Parsed results keyed by the SHA-256 of the LLaMA output, so the same evaluation
+# text doesn't go through the Mistral feedback calls again. Reading the file is cheap;
+# its mtime and size can match for two different evaluations written back to back
+RESULT_CACHE_SIZE = 32
+_result_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# Concurrent Mistral feedback requests
+FEEDBACK_WORKERS = int(os.getenv("RESULT_FEEDBACK_WORKERS", "8"))
+# "Right" verdicts in blocks shorter than this skip the feedback request
+UNAMBIGUOUS_MAX_CHARS = 200
+
+def _needs_feedback(raw_evaluation: str) -> bool:
     """
-    Read LLaMA output from llama_output.txt and use Mistral LLM to analyze and structure the results.
-    Returns {"evaluations": {...}, "total_score": int, "max_score": int}
+    Whether an evaluation is worth a Mistral feedback request. Blocks that carry
+    an explicit "(Marks: x)" or are a short "Right" verdict get no more from the
+    model than the basic feedback already says.
+    """
+    for m in VERDICT_RE.finditer(raw_evaluation):
+        if m.lastgroup == "inline":
+            return False
+        if m.lastgroup == "right" and len(raw_evaluation) < UNAMBIGUOUS_MAX_CHARS:
+            return False
+    return True
+
+def _cache_result(cache_key: str, result: Dict[str, Any]) -> None:
+    """Store a parsed result, evicting the least recently used entries."""
+    with _result_cache_lock:
+        _result_cache[cache_key] = copy.deepcopy(result)
+        _result_cache.move_to_end(cache_key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+def _score_block(block_text: str) -> Tuple[float, bool]:
+    """
+    Score one question block. The first line with an inline mark, Right or Wrong
+    decides; otherwise the first "Score: x/y" or "Marks Awarded: x" is used.
+    """
+    verdict = None
+    verdict_line_end = -1
+    score_match = None
+    for m in VERDICT_RE.finditer(block_text):
+        if verdict is not None and m.start() >= verdict_line_end:
+            break
+        kind = m.lastgroup if m.lastgroup in VERDICT_PRIORITY else None
+        if kind is None:
+            if score_match is None:
+                score_match = m
+        elif verdict is None:
+            verdict = m
+            verdict_line_end = block_text.find('\n', m.start())
+            if verdict_line_end == -1:
+                verdict_line_end = len(block_text)
+        elif VERDICT_PRIORITY[kind] < VERDICT_PRIORITY[verdict.lastgroup]:
+            verdict = m
+
+    if verdict is not None:
+        if verdict.lastgroup == "inline":
+            score = float(verdict.group("inline"))
+            return score, score > 0.0
+        return (1.0, True) if verdict.lastgroup == "right" else (0.0, False)
+
+    if score_match is not None:
+        if score_match.group("den"):
+            try:
+                score = float(score_match.group("num")) / float(score_match.group("den"))
+            except ZeroDivisionError:
+                score = float(score_match.group("num"))
+        else:
+            score = float(score_match.group("num"))
+        return score, score > 0.0
+
+    return 0.0, False
+
+def _basic_feedback(eval_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Feedback built from the raw evaluation when Mistral can't be used."""
+    return {
+        "score": eval_data["score"],
+        "feedback": eval_data["raw_evaluation"],
+        "strengths": _CORRECT[eval_data["is_correct"]],
+        "improvements": _IMPROVE[eval_data["is_correct"]]
+    }
+
+def _merge_feedback(eval_data: Dict[str, Any], feedback_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine Mistral's feedback JSON with the parsed score."""
+    return {
+        "score": eval_data["score"],
+        "feedback": feedback_data.get("feedback", eval_data["raw_evaluation"]),
+        "strengths": feedback_data.get("strengths", _SUBMITTED[eval_data["is_correct"]]),
+        "improvements": feedback_data.get("improvements", _IMPROVE[eval_data["is_correct"]])
+    }
+
+def _request_feedback_batched(evaluations: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
     """
+    Ask Mistral for feedback on every question in a single JSON-mode request.
+    Returns only the questions the response covered; callers fall back for the rest.
+    """
+    evaluation_list = "\n\n".join(
+        f"{q_num}: {eval_data['raw_evaluation']}" for q_num, eval_data in evaluations.items()
+    )
+    feedback_prompt = f"""
+Based on these evaluation results, provide detailed feedback for the student on each question:
+
+{evaluation_list}
+
+Provide a JSON object mapping each question number ({", ".join(evaluations)}) to:
+{{
+    "feedback": "detailed explanation of the evaluation",
+    "strengths": "what the student did well",
+    "improvements": "specific suggestions for improvement"
+}}
+"""
+    try:
+        response = ollama.chat(
+            model='mistral',
+            messages=[{'role': 'user', 'content': feedback_prompt}],
+            format='json',
+            options={'temperature': 0.1}
+        )
+        feedback_by_question = json.loads(response['message']['content'])
+    except Exception as e:
+        logger.warning(f"Batched feedback request failed: {e}")
+        return {}
+
+    if not isinstance(feedback_by_question, dict):
+        return {}
+    return {
+        q_num: feedback_by_question[q_num]
+        for q_num in evaluations
+        if isinstance(feedback_by_question.get(q_num), dict)
+    }
+
+def _request_feedback(q_num: str, eval_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Ask Mistral for detailed feedback on a single question's evaluation."""
     try:
-        script_dir = Path(__file__).parent
-        project_root = script_dir.parent.parent.parent
-        output_file = project_root / "llama_output.txt"
+        feedback_prompt = f"""
+Based on this evaluation result, provide detailed feedback for the student:
 
+Evaluation: {eval_data['raw_evaluation']}
+
+Provide a JSON response with:
+{{
+    "feedback": "detailed explanation of the evaluation",
+    "strengths": "what the student did well",
+    "improvements": "specific suggestions for improvement"
+}}
+"""
+        response = ollama.chat(
+            model='mistral',
+            messages=[{'role': 'user', 'content': feedback_prompt}],
+            options={'temperature': 0.1}
+        )
+        
+        feedback_response = response['message']['content'].strip()
+        
+        # Try to extract JSON
+        json_start = feedback_response.find('{')
+        json_end = feedback_response.rfind('}') + 1
+        
+        if json_start != -1 and json_end > json_start:
+            return json.loads(feedback_response[json_start:json_end])
+        # Caller falls back to basic feedback
+        return None
+            
+    except Exception as e:
+        logger.warning(f"Failed to enhance feedback for {q_num}: {e}")
+        return None
+
+def parse_llama_results(output_file: Optional[Union[str, Path]] = None) -> Dict[str, Any]:
+    """
+    Read LLaMA output from llama_output.txt (or the `output_file` the evaluation agent
+    was given) and use Mistral LLM to analyze and structure the results.
+    Returns {"evaluations": {...}, "total_score": int, "max_score": int}
+    """
+    try:
+        output_file = Path(output_file) if output_file else LLAMA_OUTPUT_FILE
         logger.info(f"Result agent looking for llama_output.txt at: {output_file}")
-        logger.info(f"Absolute path: {output_file.absolute()}")
 
-        if not output_file.exists():
+        try:
+            # No strip(): block parsing already ignores leading/trailing whitespace
+            result_text = output_file.read_text(encoding='utf-8')
+        except FileNotFoundError:
             logger.error(f"LLaMA output file not found: {output_file}")
             return {"evaluations": {}, "total_score": 0, "max_score": 0}
 
-        with open(output_file, 'r', encoding='utf-8') as f:
-            result_text = f.read().strip()
+        cache_key = hashlib.sha256(result_text.encode('utf-8')).hexdigest()
+        with _result_cache_lock:
+            cached = _result_cache.get(cache_key)
+            if cached is not None:
+                _result_cache.move_to_end(cache_key)
+        if cached is not None:
+            logger.info("LLaMA output already parsed, reusing cached evaluation results")
+            # Callers annotate the evaluations in place, so hand out a copy
+            return copy.deepcopy(cached)
 
-        if not result_text:
+        if not result_text or result_text.isspace():
             logger.error("LLaMA output file is empty")
             return {"evaluations": {}, "total_score": 0, "max_score": 0}
 
         logger.info(f"Read {len(result_text)} characters from llama_output.txt")
 
+        # The fallback evaluator writes its results as JSON. Only try json.loads when
+        # the text looks like that document, so free-form output skips the decoder.
+        stripped = result_text.lstrip()
+        if stripped[:1] == '{' and '"evaluations"' in stripped[:2048]:
+            try:
+                result = json.loads(stripped)
+            except json.JSONDecodeError:
+                result = None
+            if isinstance(result, dict) and isinstance(result.get("evaluations"), dict):
+                logger.info(f"Loaded {len(result['evaluations'])} precomputed evaluations from llama_output.txt")
+                _cache_result(cache_key, result)
+                return result
+
         # First, parse the evaluation results to determine correctness and extract marks if present
-        evaluations = {}
-        lines = result_text.split('\n')
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('Q') and ':' in line:
-                # Found a question line like "Q1: Question text"
-                q_match = re.match(r'Q(\d+)', line)
-                if q_match:
-                    q_num = f"Q{q_match.group(1)}"
-                    raw_evaluation = line
-                    score = None
-                    is_correct = False
-                    # Collect all lines for this question block
-                    block_lines = [line]
-                    j = i + 1
-                    while j < len(lines) and not (lines[j].strip().startswith('Q') and ':' in lines[j]):
-                        block_lines.append(lines[j].strip())
-                        j += 1
-                    block_text = '\n'.join(block_lines)
-                    # Try to extract marks or evaluation marker from any line in the block
-                    found = False
-                    for l in block_lines:
-                        marks_match_inline = re.search(r'\(Marks:?\s*(\d+(?:\.\d+)?)\)', l, re.IGNORECASE)
-                        if marks_match_inline:
-                            try:
-                                score = float(marks_match_inline.group(1))
-                            except Exception:
-                                score = 0.0
-                            is_correct = score > 0.0
-                            found = True
-                            break
-                        elif re.search(r'\bRight\b', l, re.IGNORECASE):
-                            score = 1.0
-                            is_correct = True
-                            found = True
-                            break
-                        elif re.search(r'\bWrong\b', l, re.IGNORECASE):
-                            score = 0.0
-                            is_correct = False
-                            found = True
-                            break
-                    # If not found, check for marks in the block as before
-                    if not found:
-                        for l in block_lines:
-                            marks_match = re.search(r'(?:Marks Awarded|Score)\s*[:=]\s*(\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?', l, re.IGNORECASE)
-                            if marks_match:
-                                if marks_match.group(2):
-                                    try:
-                                        score = float(marks_match.group(1)) / float(marks_match.group(2))
-                                    except Exception:
-                                        score = float(marks_match.group(1))
-                                else:
-                                    score = float(marks_match.group(1))
-                                is_correct = score > 0.0
-                                found = True
-                                break
-                    if score is None:
-                        score = 0.0
-                    evaluations[q_num] = {
-                        "score": score,
-                        "is_correct": is_correct,
-                        "raw_evaluation": block_text.strip()
-                    }
-                    i = j
-                else:
-                    i += 1
-            else:
-                i += 1
+        evaluation_items = []
+        # Strip every line up front so each block is a plain slice of the text,
+        # rather than splitting and stripping line by line in Python
+        result_text = '\n'.join([line.strip() for line in result_text.split('\n')])
+        # Every line starting with "Q" and containing ":" closes the previous block;
+        # only the numbered ones ("Q1: ...") open a new one.
+        boundaries = list(BLOCK_HEADER_RE.finditer(result_text))
+        for idx, header in enumerate(boundaries):
+            if header.group(1) is None:
+                continue
+            q_num = f"Q{header.group(1)}"
+            block_end = boundaries[idx + 1].start() - 1 if idx + 1 < len(boundaries) else len(result_text)
+            # Lines are already stripped and the block starts at its "Q" header, so
+            # trailing blank lines are the only whitespace left to trim
+            block_text = result_text[header.start():block_end].rstrip('\n')
+            score, is_correct = _score_block(block_text)
+            evaluation_items.append((q_num, {
+                "score": score,
+                "is_correct": is_correct,
+                "raw_evaluation": block_text
+            }))
+        evaluations = dict(evaluation_items)
         
         logger.info(f"Parsed {len(evaluations)} question evaluations from llama_output.txt")
         
         # Now enhance with detailed feedback using Mistral
         if evaluations:
-            enhanced_evaluations = {}
-            
-            for q_num, eval_data in evaluations.items():
-                if ollama:  # Only enhance if ollama is available
-                    try:
-                        feedback_prompt = f"""
-Based on this evaluation result, provide detailed feedback for the student:
+            if ollama:  # Only enhance if ollama is available
+                # Questions whose evaluation reads the same apart from the "Qn" label
+                # (e.g. several bare "Wrong" verdicts) share one feedback request
+                first_with_text = {}
+                for q_num, eval_data in evaluations.items():
+                    first_with_text.setdefault(eval_data["raw_evaluation"][len(q_num):], q_num)
+                # Clear-cut verdicts get the basic feedback without asking Mistral
+                unique = {
+                    q_num: evaluations[q_num] for q_num in first_with_text.values()
+                    if _needs_feedback(evaluations[q_num]["raw_evaluation"])
+                }
+                if len(unique) < len(evaluations):
+                    logger.info(f"Requesting feedback for {len(unique)} of {len(evaluations)} evaluations")
 
-Evaluation: {eval_data['raw_evaluation']}
+                # One request for all questions avoids paying ollama's prompt prefill N times
+                feedback = _request_feedback_batched(unique) if unique else {}
+                missing = [q_num for q_num in unique if q_num not in feedback]
+                if missing:
+                    logger.info(f"Requesting feedback individually for {len(missing)} question(s)")
+                    # Each feedback request is an independent HTTP round-trip to ollama,
+                    # so run them concurrently instead of one after another
+                    max_workers = min(FEEDBACK_WORKERS, len(missing))
+                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        feedback.update(zip(missing, executor.map(_request_feedback, missing, [unique[q] for q in missing])))
 
-Provide a JSON response with:
-{{
-    "feedback": "detailed explanation of the evaluation",
-    "strengths": "what the student did well",
-    "improvements": "specific suggestions for improvement"
-}}
-"""
-                        response = ollama.chat(
-                            model='mistral',
-                            messages=[{'role': 'user', 'content': feedback_prompt}],
-                            options={'temperature': 0.1}
-                        )
-                        
-                        feedback_response = response['message']['content'].strip()
-                        
-                        # Try to extract JSON
-                        json_start = feedback_response.find('{')
-                        json_end = feedback_response.rfind('}') + 1
-                        
-                        if json_start != -1 and json_end > json_start:
-                            feedback_data = json.loads(feedback_response[json_start:json_end])
-                            enhanced_evaluations[q_num] = {
-                                "score": eval_data["score"],
-                                "feedback": feedback_data.get("feedback", eval_data["raw_evaluation"]),
-                                "strengths": feedback_data.get("strengths", "Answer submitted" if eval_data["is_correct"] else ""),
-                                "improvements": feedback_data.get("improvements", "Review the concept" if not eval_data["is_correct"] else "")
-                            }
-                        else:
-                            # Fallback to basic feedback
-                            enhanced_evaluations[q_num] = {
-                                "score": eval_data["score"],
-                                "feedback": eval_data["raw_evaluation"],
-                                "strengths": "Correct answer" if eval_data["is_correct"] else "",
-                                "improvements": "Review the concept" if not eval_data["is_correct"] else ""
-                            }
-                            
-                    except Exception as e:
-                        logger.warning(f"Failed to enhance feedback for {q_num}: {e}")
-                        enhanced_evaluations[q_num] = {
-                            "score": eval_data["score"],
-                            "feedback": eval_data["raw_evaluation"],
-                            "strengths": "Correct answer" if eval_data["is_correct"] else "",
-                            "improvements": "Review the concept" if not eval_data["is_correct"] else ""
-                        }
-                else:
-                    # Ollama not available, use basic feedback
-                    logger.warning("Ollama not available for feedback enhancement, using basic feedback")
-                    enhanced_evaluations[q_num] = {
-                        "score": eval_data["score"],
-                        "feedback": eval_data["raw_evaluation"],
-                        "strengths": "Correct answer" if eval_data["is_correct"] else "",
-                        "improvements": "Review the concept" if not eval_data["is_correct"] else ""
-                    }
+                enhanced_evaluations = {}
+                for q_num, eval_data in evaluations.items():
+                    feedback_data = feedback.get(first_with_text[eval_data["raw_evaluation"][len(q_num):]])
+                    enhanced_evaluations[q_num] = (
+                        _merge_feedback(eval_data, feedback_data) if feedback_data is not None
+                        else _basic_feedback(eval_data)
+                    )
+            else:
+                # Ollama not available, use basic feedback
+                logger.warning("Ollama not available for feedback enhancement, using basic feedback")
+                enhanced_evaluations = {
+                    q_num: _basic_feedback(eval_data) for q_num, eval_data in evaluations.items()
+                }
             
             evaluations = enhanced_evaluations
         
@@ -191,11 +325,13 @@ Provide a JSON response with:
         total_score = sum(float(v.get('score', 0)) for v in evaluations.values())
         max_score = len(evaluations)
 
-        return {
+        result = {
             "evaluations": evaluations,
             "total_score": total_score,
             "max_score": max_score
         }
+        _cache_result(cache_key, result)
+        return result
 
     except Exception as e:
         logger.error(f"Failed to parse LLaMA results: {e}")
@@ -15,54 +15,407 @@ Features:
 """
 
 import os
-import sys
+import io
 import json
+import base64
+import asyncio
+import contextlib
 import logging
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 from PIL import Image, ImageDraw
-import cv2
-import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# torch and transformers are only needed to run the model locally; they are
+# imported on first use so importing this module (or using the vLLM server)
+# does not pay for them
+torch = None
+Qwen2VLForConditionalGeneration = None
+Qwen2VLProcessor = None
+BitsAndBytesConfig = None
+
+def _ensure_torch():
+    """Import torch and transformers into module scope, once."""
+    global torch, Qwen2VLForConditionalGeneration, Qwen2VLProcessor, BitsAndBytesConfig
+    if torch is not None:
+        return
+    try:
+        import torch as _torch
+        from transformers import (
+            Qwen2VLForConditionalGeneration as _model_class,
+            Qwen2VLProcessor as _processor_class,
+            BitsAndBytesConfig as _bnb_config,
+        )
+    except ImportError as e:
+        logger.error(f"Import failed: {e}")
+        raise
+    Qwen2VLForConditionalGeneration = _model_class
+    Qwen2VLProcessor = _processor_class
+    BitsAndBytesConfig = _bnb_config
+    torch = _torch
+
 try:
-    import torch
-    from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, Qwen2VLProcessor
-except ImportError as e:
-    logger.error(f"Import failed: {e}")
-    sys.exit(1)
+    import httpx
+except ImportError:
+    logger.warning("httpx not installed. Remote visual question server disabled.")
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson raises a subclass of json.JSONDecodeError, so callers catch either the same way
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+# Common MCQ option patterns. Each one scans the whole text and later patterns
+# overwrite earlier labels, so they stay separate rather than one alternation
+# (which would return only non-overlapping matches).
+_MCQ_OPTION_PATTERNS = tuple(
+    re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+    for pattern in (
+        r'([a-d])\)\s*([^\n]+)',  # a) option text
+        r'([a-d])\.\s*([^\n]+)',  # a. option text
+        r'\(([a-d])\)\s*([^\n]+)',  # (a) option text
+        r'([ivx]+)\)\s*([^\n]+)',  # i) ii) iii) iv) roman numerals
+        r'([ivx]+)\.\s*([^\n]+)',  # i. ii. iii. iv. roman numerals
+        r'\(([ivx]+)\)\s*([^\n]+)',  # (i) (ii) (iii) (iv) roman numerals
+    )
+)
+
+# Every option pattern needs a label letter directly before ")" or "."; one scan
+# for that pair rules out text with no options before running the six patterns
+_MCQ_LABEL_RE = re.compile(r'[a-divx][.)]', re.IGNORECASE)
+
+def _analysis_prompt(question_text: str) -> str:
+    """Instruction sent with every question image."""
+    return f"""Analyze this visual question image. Look for:
+
+1. Any visual elements like diagrams, charts, pictures, shapes, or mathematical figures
+2. Question text and multiple choice options (a,b,c,d or i,ii,iii,iv)
+3. Fill-in-the-blank questions
+4. Any counting or measurement tasks
+
+Based on the visual content, provide:
+- A description of what you see in the image
+- The question being asked
+- All available answer options (if MCQ)
+- Your reasoned answer with explanation
+- Confidence level (1-10)
+
+Question context: {question_text}
+
+Respond in JSON format:
+{{
+    "visual_description": "description of visual elements",
+    "question_text": "the question being asked",
+    "question_type": "mcq|fill_blank|counting|other",
+    "options": {{"a": "option text", "b": "option text", ...}},
+    "answer": "your answer",
+    "reasoning": "explanation of your reasoning",
+    "confidence": 8
+}}"""
+
+# Shape of the analysis the prompt asks for; the vLLM path passes it as guided_json
+# so the server can only emit a reply that parses
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "visual_description": {"type": "string"},
+        "question_text": {"type": "string"},
+        "question_type": {"enum": ["mcq", "fill_blank", "counting", "other"]},
+        "options": {"type": "object", "additionalProperties": {"type": "string"}},
+        "answer": {"type": "string"},
+        "reasoning": {"type": "string"},
+        "confidence": {"type": "integer", "minimum": 1, "maximum": 10}
+    },
+    "required": [
+        "visual_description", "question_text", "question_type",
+        "options", "answer", "reasoning", "confidence"
+    ]
+}
+
+def _parse_analysis(response: str, question_text: str) -> Dict:
+    """Turn the model's reply into an analysis dict, tolerating non-JSON replies."""
+    logger.info(f"Visual analysis response: {response[:200]}...")
+    
+    # Try to parse JSON response
+    try:
+        # Extract JSON from response
+        json_start = response.find('{')
+        json_end = response.rfind('}') + 1
+        if json_start != -1 and json_end != -1:
+            json_str = response[json_start:json_end]
+            analysis = _json_loads(json_str)
+        else:
+            # Fallback parsing
+            analysis = {
+                "visual_description": "Analysis completed",
+                "question_text": question_text,
+                "question_type": "other",
+                "options": {},
+                "answer": "Analysis provided in raw response",
+                "reasoning": response,
+                "confidence": 7
+            }
+    except json.JSONDecodeError:
+        # Fallback structure
+        analysis = {
+            "visual_description": "Visual analysis completed",
+            "question_text": question_text,
+            "question_type": "other",
+            "options": {},
+            "answer": "See reasoning for details",
+            "reasoning": response,
+            "confidence": 6
+        }
+    
+    return analysis
+
+def _failed_analysis(question_text: str, error: Exception) -> Dict:
+    """Analysis returned when the model call itself fails."""
+    return {
+        "visual_description": "Analysis failed",
+        "question_text": question_text,
+        "question_type": "error",
+        "options": {},
+        "answer": "Unable to analyze",
+        "reasoning": f"Error occurred: {str(error)}",
+        "confidence": 0
+    }
+
+# Budget for one reply that covers a whole page of questions
+PAGE_MAX_NEW_TOKENS = int(os.getenv("VISUAL_PAGE_MAX_NEW_TOKENS", "2048"))
+
+PAGE_PROMPT = """Enumerate every question on this page.
+
+For each question give its number, its bounding box, the question text, any
+answer options, and your reasoned answer. Bounding boxes are [x1, y1, x2, y2]
+with coordinates scaled to 0-1000 across the page width and height.
+
+Respond with a JSON array only, one element per question, top to bottom:
+[
+    {
+        "question_number": 1,
+        "bbox": [x1, y1, x2, y2],
+        "visual_description": "description of visual elements",
+        "question_text": "the question being asked",
+        "question_type": "mcq|fill_blank|counting|other",
+        "options": {"a": "option text", "b": "option text", ...},
+        "answer": "your answer",
+        "reasoning": "explanation of your reasoning",
+        "confidence": 8
+    }
+]"""
+
+PAGE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question_number": {"type": "integer"},
+            "bbox": {"type": "array", "items": {"type": "integer"}, "minItems": 4, "maxItems": 4},
+            **ANALYSIS_SCHEMA["properties"]
+        },
+        "required": ["question_number", "bbox"] + ANALYSIS_SCHEMA["required"]
+    }
+}
+
+def _page_bbox(bbox, width: int, height: int) -> Tuple[int, int, int, int]:
+    """Scale a 0-1000 box to pixels, clamped to the page; the whole page if it is unusable."""
+    try:
+        x1, y1, x2, y2 = (min(max(float(v), 0.0), 1000.0) for v in bbox)
+    except (TypeError, ValueError):
+        return (0, 0, width, height)
+    if x2 <= x1 or y2 <= y1:
+        return (0, 0, width, height)
+    return (
+        round(x1 * width / 1000), round(y1 * height / 1000),
+        round(x2 * width / 1000), round(y2 * height / 1000)
+    )
+
+def _parse_page(response: str, image_size: Tuple[int, int]) -> Optional[Dict[str, Dict]]:
+    """
+    Turn a page enumeration reply into the per-question entries of process_visual_paper.
+    Returns None when the reply holds no usable question list.
+    """
+    logger.info(f"Visual page response: {response[:200]}...")
+    
+    json_start = response.find('[')
+    json_end = response.rfind(']') + 1
+    if json_start == -1 or json_end <= json_start:
+        return None
+    try:
+        items = _json_loads(response[json_start:json_end])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list):
+        return None
+    
+    width, height = image_size
+    questions = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        number = item.get("question_number")
+        if not isinstance(number, int) or f"Q{number}" in questions:
+            number = i + 1
+            while f"Q{number}" in questions:
+                number += 1
+        x1, y1, x2, y2 = _page_bbox(item.get("bbox"), width, height)
+        questions[f"Q{number}"] = {
+            "region_info": {
+                "id": f"page_item_{i}",
+                "bbox": (x1, y1, x2, y2),
+                "area": (x2 - x1) * (y2 - y1),
+                "question_number": number
+            },
+            "analysis": {
+                "visual_description": item.get("visual_description", ""),
+                "question_text": item.get("question_text", ""),
+                "question_type": item.get("question_type", "other"),
+                "options": item.get("options") if isinstance(item.get("options"), dict) else {},
+                "answer": item.get("answer", ""),
+                "reasoning": item.get("reasoning", ""),
+                "confidence": item.get("confidence", 0)
+            }
+        }
+    return questions or None
 
 class VisualQuestionAgent:
-    def __init__(self, model_name: str = "Qwen/Qwen2-VL-2B-Instruct"):
-        """Initialize the visual question analysis agent."""
+    def __init__(
+        self,
+        model_name: str = "Qwen/Qwen2-VL-2B-Instruct",
+        quant: str = os.getenv("VISUAL_QUANT", "fp16"),
+        batch_size: int = int(os.getenv("VISUAL_BATCH_SIZE", "4")),
+        attn_implementation: str = os.getenv("VISUAL_ATTN", "sdpa"),
+        compile_model: bool = os.getenv("VISUAL_COMPILE", "0") == "1",
+    ):
+        """
+        Initialize the visual question analysis agent.
+        `quant` selects the weight format: fp16 (default), int8 (bitsandbytes) or
+        fp8 (fbgemm, Ada/Hopper GPUs only). The LM head is kept in fp16 either way.
+        `batch_size` caps how many question images share one generate call.
+        `attn_implementation` is passed to transformers ("sdpa" or "flash_attention_2").
+        `compile_model` wraps the forward pass in torch.compile with a static KV cache.
+        """
+        _ensure_torch()
+        self.batch_size = max(1, batch_size)
         if not torch.cuda.is_available():
             raise RuntimeError("CUDA GPU required for visual question processing.")
         
         self.device = torch.device("cuda")
         logger.info(f"Using GPU device: {self.device}")
         
-        try:
-            self.model = Qwen2VLForConditionalGeneration.from_pretrained(
-                model_name,
-                torch_dtype=torch.float16,
-                device_map="auto"
+        load_kwargs = {
+            "torch_dtype": torch.float16,
+            "device_map": "auto",
+            "attn_implementation": attn_implementation,
+            # Stream safetensors shards straight to the GPU instead of building
+            # the full state dict in host RAM first
+            "low_cpu_mem_usage": True,
+            "use_safetensors": True,
+        }
+        quant = quant.lower()
+        if quant == "int8":
+            load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_skip_modules=["lm_head"]
             )
+        elif quant == "fp8":
+            try:
+                from transformers import FbgemmFp8Config
+            except ImportError:
+                FbgemmFp8Config = None
+            if FbgemmFp8Config is None:
+                logger.warning("FP8 weights need a newer transformers (FbgemmFp8Config), falling back to fp16")
+                quant = "fp16"
+            elif torch.cuda.get_device_capability() < (8, 9):
+                logger.warning("FP8 weights need an Ada or Hopper GPU, falling back to fp16")
+                quant = "fp16"
+            else:
+                load_kwargs["quantization_config"] = FbgemmFp8Config(modules_to_not_convert=["lm_head"])
+        elif quant != "fp16":
+            logger.warning(f"Unknown VISUAL_QUANT '{quant}', falling back to fp16")
+            quant = "fp16"
+
+        # The fast tokenizer can't be entered from two threads at once, and the
+        # prefetch thread runs the processor while the caller decodes
+        self._processor_lock = threading.Lock()
+        # Becomes a Lock once the model is compiled: the static KV cache lives on the
+        # model and each generate resets it, so compiled generates must not overlap
+        self._generate_lock = contextlib.nullcontext()
+        
+        try:
+            self.model = Qwen2VLForConditionalGeneration.from_pretrained(model_name, **load_kwargs)
             self.processor = Qwen2VLProcessor.from_pretrained(model_name)
-            logger.info("Visual question model loaded successfully")
+            # Decoder-only batching needs left padding so prompts end together
+            self.processor.tokenizer.padding_side = "left"
+            self._chat_prefix, self._chat_suffix = self._split_chat_template()
+            logger.info(f"Visual question model loaded successfully ({quant} weights, {attn_implementation} attention)")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise
+        
+        if compile_model:
+            self._compile_model()
+    
+    def _compile_model(self):
+        """Compile the forward pass against a static KV cache and warm it up once."""
+        eager_forward = self.model.forward
+        try:
+            self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+            self._generate_lock = threading.Lock()
+            
+            # First call pays the compile cost; do it here instead of on a real paper.
+            # _generate raises on failure, unlike analyze_visual_questions
+            warmup_image = Image.new("RGB", (448, 448), "white")
+            self._generate(self._prepare_batch([warmup_image], ["warmup"]), max_new_tokens=8)
+            logger.info("Visual question model compiled and warmed up.")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, continuing in eager mode: {e}")
+            self.model.forward = eager_forward
+            self.model.generation_config.cache_implementation = None
+            self._generate_lock = contextlib.nullcontext()
+    
+    def _split_chat_template(self) -> Tuple[str, str]:
+        """
+        Render the chat template once around a marker and return the text on either side.
+        Only the question context varies between images, so each prompt is then a plain
+        concatenation; the processor still expands the image placeholder per image.
+        """
+        marker = "\x00QUESTION_CONTEXT\x00"
+        text = self.processor.apply_chat_template(
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image"},
+                        {"type": "text", "text": _analysis_prompt(marker)}
+                    ]
+                }
+            ],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        prefix, suffix = text.split(marker)
+        return prefix, suffix
     
     def detect_questions(self, image: Image.Image) -> List[Dict]:
         """
         Detect question numbers and their locations in the image.
         Returns list of detected questions with bounding boxes.
         """
-        # Convert PIL image to CV2 format
-        cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        gray = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
+        import cv2
+        import numpy as np
+        
+        # Straight from RGB to grayscale; no intermediate BGR copy
+        gray = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2GRAY)
         
         detected_questions = []
         
@@ -83,28 +436,31 @@ class VisualQuestionAgent:
             # Find contours
             contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             
-            # Filter contours that might contain questions
-            question_regions = []
-            for i, contour in enumerate(contours):
-                x, y, w, h = cv2.boundingRect(contour)
-                area = cv2.contourArea(contour)
-                
-                # Filter based on size (questions are usually mid-sized regions)
-                if 100 < area < 50000 and w > 20 and h > 20:
-                    question_regions.append({
-                        'id': f'region_{i}',
-                        'bbox': (x, y, x+w, y+h),
-                        'area': area,
-                        'question_number': None
-                    })
+            # Filter contours that might contain questions; boxes are kept as one
+            # (n, 4) array of x, y, w, h so the filtering and sorting run in numpy
+            bboxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int32).reshape(-1, 4)
+            
+            # Most contours are specks; reject them on the bounding box first
+            candidates = np.flatnonzero((bboxes[:, 2] > 20) & (bboxes[:, 3] > 20))
+            areas = np.array([cv2.contourArea(contours[i]) for i in candidates], dtype=np.float64)
+            
+            # Filter based on size (questions are usually mid-sized regions)
+            keep = (areas > 100) & (areas < 50000)
+            candidates, areas = candidates[keep], areas[keep]
             
             # Sort regions by y-coordinate (top to bottom) then x-coordinate (left to right)
-            question_regions.sort(key=lambda r: (r['bbox'][1], r['bbox'][0]))
+            order = np.lexsort((bboxes[candidates, 0], bboxes[candidates, 1]))
             
             # Assign question numbers based on position
-            for i, region in enumerate(question_regions[:20]):  # Limit to first 20 regions
-                region['question_number'] = i + 1
-                detected_questions.append(region)
+            for number, row in enumerate(order[:20], start=1):  # Limit to first 20 regions
+                i = int(candidates[row])
+                x, y, w, h = bboxes[i].tolist()
+                detected_questions.append({
+                    'id': f'region_{i}',
+                    'bbox': (x, y, x+w, y+h),
+                    'area': float(areas[row]),
+                    'question_number': number
+                })
             
             logger.info(f"Detected {len(detected_questions)} potential question regions")
             
@@ -131,18 +487,11 @@ class VisualQuestionAgent:
         """
         options = {}
         
-        # Common option patterns
-        patterns = [
-            r'([a-d])\)\s*([^\n]+)',  # a) option text
-            r'([a-d])\.\s*([^\n]+)',  # a. option text
-            r'\(([a-d])\)\s*([^\n]+)',  # (a) option text
-            r'([ivx]+)\)\s*([^\n]+)',  # i) ii) iii) iv) roman numerals
-            r'([ivx]+)\.\s*([^\n]+)',  # i. ii. iii. iv. roman numerals
-            r'\(([ivx]+)\)\s*([^\n]+)',  # (i) (ii) (iii) (iv) roman numerals
-        ]
+        if (')' not in text and '.' not in text) or not _MCQ_LABEL_RE.search(text):
+            return options
         
-        for pattern in patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE | re.MULTILINE)
+        for pattern in _MCQ_OPTION_PATTERNS:
+            matches = pattern.finditer(text)
             for match in matches:
                 option_label = match.group(1).lower()
                 option_text = match.group(2).strip()
@@ -161,120 +510,130 @@ class VisualQuestionAgent:
         Analyze a visual question using Qwen 2 VL model.
         Returns the analysis and suggested answer.
         """
+        return self.analyze_visual_questions([image], [question_text])[0]
+    
+    def analyze_visual_questions(self, images: List[Image.Image], question_texts: List[str]) -> List[Dict]:
+        """
+        Analyze several question images; results are in input order.
+        Images go through the model `batch_size` at a time, one generate call per chunk.
+        The next chunk is preprocessed on a worker thread while the current one generates.
+        """
+        chunks = [
+            (images[start:start + self.batch_size], question_texts[start:start + self.batch_size])
+            for start in range(0, len(images), self.batch_size)
+        ]
+        if not chunks:
+            return []
+        
+        analyses = []
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            pending = prefetch.submit(self._prepare_batch, *chunks[0])
+            for index, (_, batch_texts) in enumerate(chunks):
+                try:
+                    inputs = pending.result()
+                except Exception as e:
+                    inputs = e
+                if index + 1 < len(chunks):
+                    pending = prefetch.submit(self._prepare_batch, *chunks[index + 1])
+                
+                if isinstance(inputs, Exception):
+                    logger.error(f"Visual analysis failed for {len(batch_texts)} images: {inputs}")
+                    analyses.extend(_failed_analysis(question_text, inputs) for question_text in batch_texts)
+                else:
+                    analyses.extend(self._generate_batch(inputs, batch_texts))
+        return analyses
+    
+    def _prepare_batch(self, images: List[Image.Image], question_texts: List[str]) -> Dict:
+        """Build the padded model inputs for one batch and start copying them to the device."""
+        # One conversation per image, each with its own question context
+        texts = [self._chat_prefix + question_text + self._chat_suffix for question_text in question_texts]
+        with self._processor_lock:
+            inputs = self.processor(
+                text=texts,
+                images=images,
+                padding=True,
+                return_tensors="pt"
+            )
+        
+        # Page-locked host buffers let the host-to-device copy run asynchronously;
+        # generate runs on the same stream, so it still waits for the data
+        return {
+            key: value.pin_memory().to(self.device, non_blocking=True)
+            for key, value in inputs.items()
+        }
+    
+    def _generate(self, inputs: Dict, max_new_tokens: int = 512) -> List[str]:
+        """Run prepared inputs through one generate call and decode the new tokens."""
+        # Greedy decoding, since this is extraction rather than open-ended generation
+        with self._generate_lock, torch.inference_mode():
+            generated_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                num_beams=1,
+                use_cache=True
+            )
+        
+        # Left padding lines every prompt up at the same length, so the
+        # generated tokens start at the same column for the whole batch
+        with self._processor_lock:
+            return self.processor.batch_decode(
+                generated_ids[:, inputs["input_ids"].shape[1]:],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )
+    
+    def _generate_batch(self, inputs: Dict, question_texts: List[str]) -> List[Dict]:
+        """Run one prepared batch through a single generate call."""
         try:
-            # Create conversation for visual analysis
-            conversation = [
+            responses = self._generate(inputs)
+            return [
+                _parse_analysis(response, question_text)
+                for response, question_text in zip(responses, question_texts)
+            ]
+            
+        except Exception as e:
+            logger.error(f"Visual analysis failed for {len(question_texts)} images: {e}")
+            return [_failed_analysis(question_text, e) for question_text in question_texts]
+    
+    def _generate_page(self, image: Image.Image) -> str:
+        """Ask the model to enumerate every question on the page in one reply."""
+        text = self.processor.apply_chat_template(
+            [
                 {
                     "role": "user",
                     "content": [
-                        {"type": "image", "image": image},
-                        {"type": "text", "text": f"""Analyze this visual question image. Look for:
-
-1. Any visual elements like diagrams, charts, pictures, shapes, or mathematical figures
-2. Question text and multiple choice options (a,b,c,d or i,ii,iii,iv)
-3. Fill-in-the-blank questions
-4. Any counting or measurement tasks
-
-Based on the visual content, provide:
-- A description of what you see in the image
-- The question being asked
-- All available answer options (if MCQ)
-- Your reasoned answer with explanation
-- Confidence level (1-10)
-
-Question context: {question_text}
-
-Respond in JSON format:
-{{
-    "visual_description": "description of visual elements",
-    "question_text": "the question being asked",
-    "question_type": "mcq|fill_blank|counting|other",
-    "options": {{"a": "option text", "b": "option text", ...}},
-    "answer": "your answer",
-    "reasoning": "explanation of your reasoning",
-    "confidence": 8
-}}"""}
+                        {"type": "image"},
+                        {"type": "text", "text": PAGE_PROMPT}
                     ]
                 }
-            ]
-            
-            # Process the conversation
-            text = self.processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
-            inputs = self.processor(
-                text=[text],
-                images=[image],
-                padding=True,
-                return_tensors="pt"
-            ).to(self.device)
-            
-            # Generate response
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    temperature=0.1,
-                    do_sample=True
-                )
-                
-                # Decode the response
-                generated_ids_trimmed = [
-                    out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-                ]
-                response = self.processor.batch_decode(
-                    generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-                )[0]
-            
-            logger.info(f"Visual analysis response: {response[:200]}...")
-            
-            # Try to parse JSON response
-            try:
-                # Extract JSON from response
-                json_start = response.find('{')
-                json_end = response.rfind('}') + 1
-                if json_start != -1 and json_end != -1:
-                    json_str = response[json_start:json_end]
-                    analysis = json.loads(json_str)
-                else:
-                    # Fallback parsing
-                    analysis = {
-                        "visual_description": "Analysis completed",
-                        "question_text": question_text,
-                        "question_type": "other",
-                        "options": {},
-                        "answer": "Analysis provided in raw response",
-                        "reasoning": response,
-                        "confidence": 7
-                    }
-            except json.JSONDecodeError:
-                # Fallback structure
-                analysis = {
-                    "visual_description": "Visual analysis completed",
-                    "question_text": question_text,
-                    "question_type": "other",
-                    "options": {},
-                    "answer": "See reasoning for details",
-                    "reasoning": response,
-                    "confidence": 6
-                }
-            
-            return analysis
-            
+            ],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        with self._processor_lock:
+            inputs = self.processor(text=[text], images=[image], return_tensors="pt")
+        return self._generate(inputs.to(self.device), max_new_tokens=PAGE_MAX_NEW_TOKENS)[0]
+    
+    def enumerate_questions(self, image: Image.Image) -> Optional[Dict[str, Dict]]:
+        """
+        Detect and answer every question on the page with a single model call.
+        Returns None if the reply could not be turned into a question list.
+        """
+        try:
+            return _parse_page(self._generate_page(image), image.size)
         except Exception as e:
-            logger.error(f"Visual analysis failed: {e}")
-            return {
-                "visual_description": "Analysis failed",
-                "question_text": question_text,
-                "question_type": "error",
-                "options": {},
-                "answer": "Unable to analyze",
-                "reasoning": f"Error occurred: {str(e)}",
-                "confidence": 0
-            }
+            logger.error(f"Page question enumeration failed: {e}")
+            return None
     
-    def process_visual_paper(self, image_path: str) -> Dict:
+    def process_visual_paper(self, image_path: str, analyze_full_page: bool = False, legacy_detect: bool = False) -> Dict:
         """
         Process a complete visual question paper.
         Returns structured analysis of all detected questions.
+        By default one model call both finds and answers the questions; `legacy_detect`
+        (or a reply that cannot be parsed) uses contour detection and one pass per region.
+        The whole page is only analyzed separately when `analyze_full_page` is set
+        or no question regions were found.
         """
         try:
             # Open the image
@@ -285,53 +644,22 @@ Respond in JSON format:
             
             logger.info(f"Processing visual question paper: {image.size}")
             
-            # Detect questions in the image
-            detected_questions = self.detect_questions(image)
-            
-            results = {
-                "status": "success",
-                "total_questions": len(detected_questions),
-                "questions": {},
-                "full_image_analysis": None
-            }
-            
-            # First, analyze the full image to get overall context
-            full_analysis = self.analyze_visual_question(image, "Analyze this complete question paper")
-            results["full_image_analysis"] = full_analysis
-            
-            # Process each detected question region
-            for i, question_region in enumerate(detected_questions):
-                q_id = f"Q{question_region['question_number']}"
-                
-                try:
-                    # Crop the question region
-                    cropped_image = self.crop_question_region(image, question_region['bbox'])
-                    
-                    # Analyze this specific question
-                    analysis = self.analyze_visual_question(
-                        cropped_image, 
-                        f"Question {question_region['question_number']}"
-                    )
-                    
-                    # Store the analysis
-                    results["questions"][q_id] = {
-                        "region_info": question_region,
-                        "analysis": analysis
-                    }
-                    
-                    logger.info(f"Processed {q_id}: {analysis.get('question_type', 'unknown')} question")
-                    
-                except Exception as e:
-                    logger.error(f"Failed to process question region {q_id}: {e}")
-                    results["questions"][q_id] = {
-                        "region_info": question_region,
-                        "analysis": {
-                            "error": str(e),
-                            "status": "failed"
-                        }
+            if not legacy_detect:
+                questions = self.enumerate_questions(image)
+                if questions:
+                    logger.info(f"Model enumerated {len(questions)} questions")
+                    return {
+                        "status": "success",
+                        "total_questions": len(questions),
+                        "questions": questions,
+                        "full_image_analysis": (
+                            self.analyze_visual_question(image, "Analyze this complete question paper")
+                            if analyze_full_page else None
+                        )
                     }
+                logger.warning("Page enumeration gave no questions; falling back to region detection")
             
-            return results
+            return self._process_regions(image, analyze_full_page)
             
         except Exception as e:
             logger.error(f"Visual paper processing failed: {e}")
@@ -342,6 +670,65 @@ Respond in JSON format:
                 "questions": {}
             }
     
+    def _process_regions(self, image: Image.Image, analyze_full_page: bool) -> Dict:
+        """Detect question regions with OpenCV and analyze each crop."""
+        # Detect questions in the image
+        detected_questions = self.detect_questions(image)
+        
+        results = {
+            "status": "success",
+            "total_questions": len(detected_questions),
+            "questions": {},
+            "full_image_analysis": None
+        }
+        
+        # Crop every question region up front so the full page and all
+        # regions can be analyzed in one call
+        regions = []
+        for question_region in detected_questions:
+            q_id = f"Q{question_region['question_number']}"
+            try:
+                cropped_image = self.crop_question_region(image, question_region['bbox'])
+                regions.append((q_id, question_region, cropped_image))
+                # Filled in below; inserting now keeps the detection order
+                results["questions"][q_id] = {
+                    "region_info": question_region,
+                    "analysis": None
+                }
+            except Exception as e:
+                logger.error(f"Failed to process question region {q_id}: {e}")
+                results["questions"][q_id] = {
+                    "region_info": question_region,
+                    "analysis": {
+                        "error": str(e),
+                        "status": "failed"
+                    }
+                }
+        
+        # The per-region passes already cover every question; the full page
+        # only adds overall context, at the cost of one more image in the batch
+        full_page = [image] if analyze_full_page or not regions else []
+        analyses = self.analyze_visual_questions(
+            full_page + [cropped_image for _, _, cropped_image in regions],
+            ["Analyze this complete question paper"] * len(full_page)
+            + [f"Question {question_region['question_number']}" for _, question_region, _ in regions]
+        )
+        if full_page:
+            results["full_image_analysis"] = analyses[0]
+        
+        for (q_id, _, _), analysis in zip(regions, analyses[len(full_page):]):
+            # Store the analysis
+            results["questions"][q_id]["analysis"] = analysis
+            
+            logger.info(f"Processed {q_id}: {analysis.get('question_type', 'unknown')} question")
+        
+        return results
+    
+    def reset_cache(self):
+        """Return cached activation/KV blocks to the GPU between papers, keeping the weights loaded."""
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
     def cleanup(self):
         """Clean up GPU memory."""
         if hasattr(self, 'model'):
@@ -349,21 +736,123 @@ Respond in JSON format:
         if hasattr(self, 'processor'):
             del self.processor
         
-        if torch.cuda.is_available():
+        if torch is not None and torch.cuda.is_available():
             torch.cuda.empty_cache()
         
         logger.info("Visual question agent cleaned up")
 
+class VLLMVisualQuestionAgent(VisualQuestionAgent):
+    """
+    Visual question agent backed by an OpenAI-compatible vLLM server, e.g.
+
+        VLLM_WORKER_MULTIPROC_METHOD=spawn vllm serve Qwen/Qwen2-VL-2B-Instruct --max-num-seqs 16
+
+    All images of a paper are sent concurrently, so the server's continuous
+    batching and paged KV cache process them together instead of one generate
+    call per region.
+    """
+
+    def __init__(
+        self,
+        server_url: str = os.getenv("VISUAL_SERVER_URL", "http://localhost:8000"),
+        model_name: str = "Qwen/Qwen2-VL-2B-Instruct",
+    ):
+        if not httpx:
+            raise RuntimeError("httpx required for remote visual question server")
+        self.server_url = server_url.rstrip("/")
+        self.model_name = model_name
+        logger.info(f"Using remote visual question server: {self.server_url}")
+
+    def analyze_visual_questions(self, images: List[Image.Image], question_texts: List[str]) -> List[Dict]:
+        """Analyze several question images concurrently; results are in input order."""
+        return asyncio.run(self._analyze_remote_many(images, question_texts))
+
+    async def _analyze_remote_many(self, images: List[Image.Image], question_texts: List[str]) -> List[Dict]:
+        async with httpx.AsyncClient(base_url=self.server_url, timeout=300) as client:
+            return await asyncio.gather(
+                *(self._analyze_remote(client, image, question_text)
+                  for image, question_text in zip(images, question_texts))
+            )
+
+    def _payload(self, image: Image.Image, prompt: str, max_tokens: int, schema: Dict) -> Dict:
+        """Chat completions request for one image; `schema` constrains the reply via guided_json."""
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=95)
+        image_b64 = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+        return {
+            "model": self.model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
+                        {"type": "text", "text": prompt},
+                    ],
+                }
+            ],
+            "max_tokens": max_tokens,
+            "temperature": 0,
+            "guided_json": schema,
+        }
+
+    async def _analyze_remote(self, client: "httpx.AsyncClient", image: Image.Image, question_text: str) -> Dict:
+        """Analyze one image through the chat completions endpoint."""
+        try:
+            payload = self._payload(image, _analysis_prompt(question_text), 512, ANALYSIS_SCHEMA)
+            response = await client.post("/v1/chat/completions", json=payload)
+            response.raise_for_status()
+            return _parse_analysis(response.json()["choices"][0]["message"]["content"], question_text)
+        except Exception as e:
+            logger.error(f"Visual analysis failed: {e}")
+            return _failed_analysis(question_text, e)
+
+    def _generate_page(self, image: Image.Image) -> str:
+        """Ask the server to enumerate every question on the page in one reply."""
+        payload = self._payload(image, PAGE_PROMPT, PAGE_MAX_NEW_TOKENS, PAGE_SCHEMA)
+        with httpx.Client(base_url=self.server_url, timeout=300) as client:
+            response = client.post("/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def cleanup(self):
+        """Nothing is held locally; the server owns the model."""
+        logger.info("Visual question agent cleaned up")
+
+_agent: Optional[VisualQuestionAgent] = None
+_agent_lock = threading.Lock()
+
+def get_agent() -> VisualQuestionAgent:
+    """Return the process-wide visual question agent, loading the model on first use."""
+    global _agent
+    with _agent_lock:
+        if _agent is None:
+            # VISUAL_SERVER_URL routes analysis to a vLLM server instead of a local model
+            _agent = VLLMVisualQuestionAgent() if os.getenv("VISUAL_SERVER_URL") else VisualQuestionAgent()
+        return _agent
+
+def shutdown_agent():
+    """Drop the shared visual question agent and free its GPU memory."""
+    global _agent
+    with _agent_lock:
+        agent, _agent = _agent, None
+    if agent:
+        agent.cleanup()
+
 # Standalone function for easy import
 def process_visual_questions(image_path: str) -> Dict:
     """
     Standalone function to process visual questions.
-    Creates agent instance, processes, and cleans up.
+    Uses the shared agent, so the model is only loaded on the first call.
     """
     agent = None
     try:
-        agent = VisualQuestionAgent()
-        return agent.process_visual_paper(image_path)
+        agent = get_agent()
+        return agent.process_visual_paper(
+            image_path,
+            analyze_full_page=os.getenv("VISUAL_ANALYZE_FULL_PAGE", "0") == "1",
+            legacy_detect=os.getenv("VISUAL_LEGACY_DETECT", "0") == "1"
+        )
     except Exception as e:
         logger.error(f"Visual question processing failed: {e}")
         return {
@@ -374,4 +863,4 @@ def process_visual_questions(image_path: str) -> Dict:
         }
     finally:
         if agent:
-            agent.cleanup()
\ No newline at end of file
+            agent.reset_cache()
@@ -3,7 +3,9 @@ Database connection and operations for MongoDB using Motor.
 """
 
 import os
+import asyncio
 import logging
+import time
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ConnectionFailure
 from typing import Dict, Any, List
@@ -11,7 +13,35 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Per-process connection pool; uvicorn workers each hold their own
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "20"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "2"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "2000"))
+# zstd needs the optional zstandard package; pymongo skips it with a warning otherwise
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "zstd")
+
+# Analytics are read-mostly; serve a cached copy for this many seconds
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "30"))
+
 class Database:
+    _client = None
+    _client_pid = None
+
+    @classmethod
+    def get_client(cls, mongodb_url: str) -> AsyncIOMotorClient:
+        # Clients are not fork-safe, so each worker process creates its own, once
+        if cls._client is None or cls._client_pid != os.getpid():
+            options = {
+                "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+                "minPoolSize": MONGODB_MIN_POOL_SIZE,
+                "serverSelectionTimeoutMS": MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            }
+            if MONGODB_COMPRESSORS:
+                options["compressors"] = MONGODB_COMPRESSORS
+            cls._client = AsyncIOMotorClient(mongodb_url, **options)
+            cls._client_pid = os.getpid()
+        return cls._client
+
     def __init__(self):
         self.mongodb_url = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
         self.client = None
@@ -20,10 +50,11 @@ class Database:
         self.answers = None
         self.evaluations = None
         self.connected = False
+        self._analytics_cache = None  # (expires_at, analytics)
 
     async def connect(self):
         try:
-            self.client = AsyncIOMotorClient(self.mongodb_url)
+            self.client = self.get_client(self.mongodb_url)
             # Test connection
             await self.client.admin.command('ping')
             self.db = self.client.exam_evaluation
@@ -32,14 +63,28 @@ class Database:
             self.evaluations = self.db.evaluations
             self.connected = True
             logger.info("Connected to MongoDB")
+            await self.create_indexes()
         except ConnectionFailure as e:
             logger.warning(f"MongoDB connection failed: {e}. Running in offline mode.")
             self.connected = False
             raise  # Re-raise to let main.py handle it
 
+    async def create_indexes(self):
+        # Lookups by submission_id and the subject breakdown would otherwise scan
+        # whole collections; create_index is a no-op when the index already exists
+        try:
+            await asyncio.gather(
+                self.answers.create_index("submission_id", unique=True),
+                self.evaluations.create_index("submission_id", unique=True),
+                self.submissions.create_index([("subject", 1), ("timestamp", -1)])
+            )
+        except Exception as e:
+            logger.warning(f"Failed to create MongoDB indexes: {e}")
+
     async def disconnect(self):
         if self.client and self.connected:
             self.client.close()
+            Database._client = None
             logger.info("Disconnected from MongoDB")
 
     async def save_submission(self, submission: Dict[str, Any]) -> str:
@@ -66,6 +111,20 @@ class Database:
             logger.error(f"Failed to save answers: {e}")
             raise
 
+    async def save_answers_bulk(self, answers_list: List[Dict[str, Any]]) -> List[str]:
+        if not self.connected:
+            # Return mock IDs for testing without database
+            import uuid
+            return [str(uuid.uuid4()) for _ in answers_list]
+        if not answers_list:
+            return []
+        try:
+            result = await self.answers.insert_many(answers_list, ordered=False)
+            return [str(inserted_id) for inserted_id in result.inserted_ids]
+        except Exception as e:
+            logger.error(f"Failed to save answers: {e}")
+            raise
+
     async def save_evaluation(self, evaluation: Dict[str, Any]) -> str:
         if not self.connected:
             # Return a mock ID for testing without database
@@ -78,6 +137,15 @@ class Database:
             logger.error(f"Failed to save evaluation: {e}")
             raise
 
+    async def save_all(self, submission: Dict[str, Any], answers: Dict[str, Any], evaluation: Dict[str, Any]) -> str:
+        # Answers and evaluation reference the submission id, so the submission goes
+        # first; the other two inserts are independent and run together
+        submission_id = await self.save_submission(submission)
+        answers["submission_id"] = submission_id
+        evaluation["submission_id"] = submission_id
+        await asyncio.gather(self.save_answers(answers), self.save_evaluation(evaluation))
+        return submission_id
+
     async def get_submission(self, submission_id: str) -> Dict[str, Any]:
         if not self.connected:
             # Return mock data for testing
@@ -116,31 +184,40 @@ class Database:
                 "average_score": 78.5,
                 "subject_breakdown": {"Mathematics": 5, "Physics": 3, "Chemistry": 2}
             }
+        if self._analytics_cache and self._analytics_cache[0] > time.monotonic():
+            return dict(self._analytics_cache[1])
         try:
-            total_submissions = await self.submissions.count_documents({})
+            # One pass over submissions yields both the count and the per-subject totals
+            submission_pipeline = [
+                {"$facet": {
+                    "total": [{"$count": "n"}],
+                    "by_subject": [{"$group": {"_id": "$subject", "count": {"$sum": 1}}}]
+                }}
+            ]
             pipeline = [
                 {"$group": {"_id": None, "avg_score": {"$avg": "$total_score"}, "total_max": {"$sum": "$max_score"}}}
             ]
-            result = await self.evaluations.aggregate(pipeline).to_list(1)
+            # The two aggregations are independent, so issue them together
+            facets, result = await asyncio.gather(
+                self.submissions.aggregate(submission_pipeline).to_list(1),
+                self.evaluations.aggregate(pipeline).to_list(1)
+            )
+            facets = facets[0] if facets else {}
+            total = facets.get("total")
+            total_submissions = total[0]["n"] if total else 0
             avg_score = result[0]["avg_score"] if result else 0
+            subject_dict = {item["_id"]: item["count"] for item in facets.get("by_subject", [])}
 
-            subject_pipeline = [
-                {"$group": {"_id": "$subject", "count": {"$sum": 1}}}
-            ]
-            subject_breakdown = await self.submissions.aggregate(subject_pipeline).to_list(None)
-            subject_dict = {item["_id"]: item["count"] for item in subject_breakdown}
-
-            return {
+            analytics = {
                 "total_submissions": total_submissions,
                 "average_score": avg_score,
                 "subject_breakdown": subject_dict
             }
+            self._analytics_cache = (time.monotonic() + ANALYTICS_CACHE_TTL, analytics)
+            return dict(analytics)
         except Exception as e:
             logger.error(f"Failed to get analytics: {e}")
             raise
 
-# Global instance
-db = Database()
-
 # Global instance
 db = Database()
\ No newline at end of file
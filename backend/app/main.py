@@ -3,22 +3,26 @@ FastAPI backend for the multi-agent exam evaluation system.
 """
 
 import asyncio
-import json
+import copy
+import hashlib
 import logging
 import os
 import uuid
 from datetime import datetime
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from typing import Any, Dict, Set
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 
 from .orchestrator import Orchestrator
 from .database import db
+from .upload_store import jobs, uploads
+from .utils.file_utils import render_pdf_page, write_json_files_in_background
 from .models.schemas import SubmissionRequest, SubmissionResponse, AnalyticsResponse
+from .utils import logger as _log_setup  # noqa: F401 - configures root logging on import
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Exam Evaluation API", version="1.0.0")
@@ -32,12 +36,51 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create uploads directory
-UPLOAD_DIR = Path("uploads")
+# Create uploads directory; point UPLOAD_DIR at a shared mount when running several workers
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "uploads"))
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Global variables for file paths (in production, use database)
-uploaded_files = {}
+# Accepted upload extensions per endpoint
+ANSWER_SHEET_EXTS = frozenset({'.pdf', '.jpg', '.jpeg', '.png'})
+QUESTION_KEY_EXTS = frozenset({'.pdf', '.docx'})
+VISUAL_EXTS = ANSWER_SHEET_EXTS
+
+# One orchestrator for the process, so agent imports and loaded models carry over between requests
+orchestrator = Orchestrator()
+
+def get_orchestrator() -> Orchestrator:
+    return orchestrator
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# /process runs keyed by (answer_sheet_id, question_key_id, student_name, subject)
+_inflight_submissions: Dict[tuple, asyncio.Task] = {}
+
+# Background /process jobs beyond this many wait for a free slot; each one that
+# finishes lets the next queued job start immediately
+PROCESS_JOB_SEM = asyncio.Semaphore(int(os.getenv("PROCESS_CONCURRENCY", "2")))
+# Strong references so running jobs aren't garbage collected
+_background_jobs: Set[asyncio.Task] = set()
+
+# Visual papers share one GPU; more concurrent runs than this wait instead of
+# competing for memory
+VISUAL_GPU_SEM = asyncio.Semaphore(int(os.getenv("VISUAL_CONCURRENCY", "2")))
+
+def _copy_upload(source, file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "wb") as buffer:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            buffer.write(chunk)
+    return digest.hexdigest()
+
+async def save_upload(file: UploadFile, file_path: Path) -> str:
+    """
+    Copy an upload to disk in 1 MB chunks on a worker thread, never holding it all in memory.
+    Returns the SHA-256 of the content, which keys the orchestrator's result cache.
+    """
+    await file.seek(0)
+    return await asyncio.to_thread(_copy_upload, file.file, file_path)
 
 # Database events - disabled for testing
 @app.on_event("startup")
@@ -47,6 +90,9 @@ async def startup_event():
         logger.info("Database connected successfully")
     except Exception as e:
         logger.warning(f"Database connection failed: {e}. Running in offline mode.")
+    # Upload and job ids must resolve on whichever worker handles the request
+    await uploads.connect()
+    await jobs.connect()
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -54,6 +100,11 @@ async def shutdown_event():
         await db.disconnect()
     except:
         pass
+    try:
+        await uploads.disconnect()
+        await jobs.disconnect()
+    except:
+        pass
 
 @app.post("/upload/answer_sheet", response_model=dict)
 async def upload_answer_sheet(file: UploadFile = File(...)):
@@ -62,19 +113,16 @@ async def upload_answer_sheet(file: UploadFile = File(...)):
     """
     try:
         # Validate file type
-        allowed_exts = {'.pdf', '.jpg', '.jpeg', '.png'}
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in allowed_exts:
+        file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext not in ANSWER_SHEET_EXTS:
             raise HTTPException(status_code=400, detail="Only PDF and image files are supported for answer sheets")
 
         # Save uploaded file
         file_id = str(uuid.uuid4())
         file_path = UPLOAD_DIR / f"{file_id}_answer_sheet{file_ext}"
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        file_hash = await save_upload(file, file_path)
 
-        uploaded_files[file_id] = {"answer_sheet": str(file_path)}
+        await uploads.set(file_id, {"answer_sheet": str(file_path), "sha256": file_hash})
         logger.info(f"Answer sheet saved: {file_path}")
 
         return {"file_id": file_id, "message": "Answer sheet uploaded successfully"}
@@ -90,19 +138,16 @@ async def upload_question_key(file: UploadFile = File(...)):
     """
     try:
         # Validate file type
-        allowed_exts = {'.pdf', '.docx'}
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in allowed_exts:
+        file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext not in QUESTION_KEY_EXTS:
             raise HTTPException(status_code=400, detail="Only PDF and DOCX files are supported for question keys")
 
         # Save uploaded file
         file_id = str(uuid.uuid4())
         file_path = UPLOAD_DIR / f"{file_id}_question_key{file_ext}"
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        file_hash = await save_upload(file, file_path)
 
-        uploaded_files[file_id] = {"question_key": str(file_path)}
+        await uploads.set(file_id, {"question_key": str(file_path), "sha256": file_hash})
         logger.info(f"Question key saved: {file_path}")
 
         return {"file_id": file_id, "message": "Question key uploaded successfully"}
@@ -111,87 +156,163 @@ async def upload_question_key(file: UploadFile = File(...)):
         logger.error(f"Question key upload failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _grade_submission(
+    orchestrator: Orchestrator,
+    answer_sheet_files: Dict[str, str],
+    question_key_files: Dict[str, str],
+    student_name: str,
+    subject: str
+) -> Dict[str, Any]:
+    """Run the pipeline for one submission and save it to the database."""
+    answer_sheet_path = answer_sheet_files["answer_sheet"]
+    question_key_path = question_key_files["question_key"]
+
+    # Process the submission
+    result = await orchestrator.process_submission(
+        answer_sheet_path,
+        question_key_path,
+        answer_sheet_hash=answer_sheet_files.get("sha256"),
+        question_key_hash=question_key_files.get("sha256")
+    )
+
+    # Add student info to result
+    result['student_name'] = student_name
+    result['subject'] = result.get('subject', subject)
+
+    # Save to database (optional, for analytics)
+    try:
+        from datetime import datetime
+        submission = {
+            "student_name": student_name,
+            "subject": result.get("subject", subject),
+            "timestamp": datetime.utcnow(),
+            "status": result.get("status", "unknown")
+        }
+        answers = {
+            "answers": result.get("student_answers", {})
+        }
+        evaluation = {
+            "results": result.get("evaluation", {}),
+            "total_score": result.get("total_score", 0),
+            "max_score": result.get("max_score", 0)
+        }
+        submission_id = await db.save_all(submission, answers, evaluation)
+
+        result['submission_id'] = submission_id
+    except Exception as db_error:
+        logger.warning(f"Database save failed: {db_error}. Continuing without database.")
+
+    return result
+
+def _start_grading(
+    orchestrator: Orchestrator,
+    answer_sheet_id: str,
+    question_key_id: str,
+    answer_sheet_files: Dict[str, str],
+    question_key_files: Dict[str, str],
+    student_name: str,
+    subject: str
+) -> asyncio.Task:
+    """
+    Start grading a submission, or return the run already in flight for the same
+    request (double submits, client retries) instead of grading the files again.
+    """
+    key = (answer_sheet_id, question_key_id, student_name, subject)
+    task = _inflight_submissions.get(key)
+    if task is None:
+        task = asyncio.create_task(_grade_submission(
+            orchestrator, answer_sheet_files, question_key_files, student_name, subject
+        ))
+        _inflight_submissions[key] = task
+        task.add_done_callback(lambda _: _inflight_submissions.pop(key, None))
+    else:
+        logger.info(f"Joining in-flight grading of {answer_sheet_id} / {question_key_id}")
+    return task
+
+async def _run_job(job_id: str, *grading_args):
+    """Grade a submission in the background, recording its progress under job_id."""
+    try:
+        async with PROCESS_JOB_SEM:
+            await jobs.set(job_id, {"job_id": job_id, "status": "running"})
+            result = await asyncio.shield(_start_grading(*grading_args))
+        record = {"job_id": job_id, "status": "completed", "result": result}
+    except Exception as e:
+        logger.error(f"Background processing failed for job {job_id}: {e}")
+        record = {"job_id": job_id, "status": "failed", "error": str(e)}
+    await jobs.set(job_id, jsonable_encoder(record))
+
 @app.post("/process", response_model=dict)
 async def process_submission(
     answer_sheet_id: str = Form(...),
     question_key_id: str = Form(...),
     student_name: str = Form("Anonymous"),
-    subject: str = Form("General")
+    subject: str = Form("General"),
+    background: bool = Form(False),
+    orchestrator: Orchestrator = Depends(get_orchestrator)
 ):
     """
     Trigger multi-agent processing pipeline for uploaded files.
+    With background=true, returns 202 and a job_id to poll at /jobs/{job_id}.
     """
     try:
-        # Check if both file IDs exist
-        if answer_sheet_id not in uploaded_files:
+        # Check if both file IDs exist and get their file paths
+        answer_sheet_files, question_key_files = await asyncio.gather(
+            uploads.get(answer_sheet_id), uploads.get(question_key_id)
+        )
+        if answer_sheet_files is None:
             raise HTTPException(status_code=404, detail="Answer sheet file ID not found")
-        if question_key_id not in uploaded_files:
+        if question_key_files is None:
             raise HTTPException(status_code=404, detail="Question key file ID not found")
 
-        # Get file paths
-        answer_sheet_files = uploaded_files[answer_sheet_id]
-        question_key_files = uploaded_files[question_key_id]
-
         if "answer_sheet" not in answer_sheet_files:
             raise HTTPException(status_code=400, detail="Answer sheet file not found")
         if "question_key" not in question_key_files:
             raise HTTPException(status_code=400, detail="Question key file not found")
 
-        answer_sheet_path = answer_sheet_files["answer_sheet"]
-        question_key_path = question_key_files["question_key"]
-
-        # Process the submission
-        orchestrator = Orchestrator()
-        result = await orchestrator.process_submission(answer_sheet_path, question_key_path)
-
-        # Add student info to result
-        result['student_name'] = student_name
-        result['subject'] = result.get('subject', subject)
-
-        # Save to database (optional, for analytics)
-        try:
-            from datetime import datetime
-            submission = {
-                "student_name": student_name,
-                "subject": result.get("subject", subject),
-                "timestamp": datetime.utcnow(),
-                "status": result.get("status", "unknown")
-            }
-            submission_id = await db.save_submission(submission)
-
-            answers = {
-                "submission_id": submission_id,
-                "answers": result.get("student_answers", {})
-            }
-            await db.save_answers(answers)
-
-            evaluation = {
-                "submission_id": submission_id,
-                "results": result.get("evaluation", {}),
-                "total_score": result.get("total_score", 0),
-                "max_score": result.get("max_score", 0)
-            }
-            await db.save_evaluation(evaluation)
-
-            result['submission_id'] = submission_id
-        except Exception as db_error:
-            logger.warning(f"Database save failed: {db_error}. Continuing without database.")
+        grading_args = (
+            orchestrator, answer_sheet_id, question_key_id,
+            answer_sheet_files, question_key_files, student_name, subject
+        )
 
-        return result
+        if background:
+            job_id = uuid.uuid4().hex
+            await jobs.set(job_id, {"job_id": job_id, "status": "pending"})
+            job = asyncio.create_task(_run_job(job_id, *grading_args))
+            _background_jobs.add(job)
+            job.add_done_callback(_background_jobs.discard)
+            return JSONResponse(status_code=202, content={"job_id": job_id, "status": "pending"})
+
+        # Shielded so one client disconnecting doesn't cancel the run for the others
+        result = await asyncio.shield(_start_grading(*grading_args))
+
+        # Every caller gets its own copy to serialize
+        return copy.deepcopy(result)
 
     except Exception as e:
         logger.error(f"Processing failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}", response_model=dict)
+async def get_job(job_id: str):
+    """
+    Poll a background /process job: pending, running, completed (with result) or failed.
+    """
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @app.get("/results/{submission_id}", response_model=dict)
 async def get_results(submission_id: str):
     """
     Fetch detailed result for a submission.
     """
     try:
-        submission = await db.get_submission(submission_id)
-        answers = await db.get_answers(submission_id)
-        evaluation = await db.get_evaluation(submission_id)
+        submission, answers, evaluation = await asyncio.gather(
+            db.get_submission(submission_id),
+            db.get_answers(submission_id),
+            db.get_evaluation(submission_id)
+        )
 
         if not submission:
             raise HTTPException(status_code=404, detail="Submission not found")
@@ -213,7 +334,7 @@ async def get_analytics():
     """
     try:
         analytics = await db.get_analytics()
-        return AnalyticsResponse(**analytics)
+        return AnalyticsResponse.model_validate(analytics)
 
     except Exception as e:
         logger.error(f"Failed to get analytics: {e}")
@@ -227,30 +348,27 @@ async def process_visual_questions(file: UploadFile = File(...)):
     """
     try:
         # Validate file type
-        allowed_exts = {'.pdf', '.jpg', '.jpeg', '.png'}
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in allowed_exts:
+        file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext not in VISUAL_EXTS:
             raise HTTPException(status_code=400, detail="Only PDF and image files are supported for visual questions")
 
         # Save uploaded file
         file_id = str(uuid.uuid4())
         file_path = UPLOAD_DIR / f"{file_id}_visual_questions{file_ext}"
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        file_hash = await save_upload(file, file_path)
 
         logger.info(f"Visual question paper saved: {file_path}")
 
         # Convert PDF to image if needed
         if file_ext == '.pdf':
             try:
-                from pdf2image import convert_from_path
-                pages = convert_from_path(str(file_path))
-                if pages:
-                    # Use first page for now
-                    image_path = UPLOAD_DIR / f"{file_id}_visual_page_1.jpg"
-                    pages[0].save(image_path, 'JPEG')
-                    processing_path = str(image_path)
+                # Use first page for now; only that page is rasterized
+                image_path = UPLOAD_DIR / f"{file_id}_visual_page_1.jpg"
+                rendered_path = await asyncio.to_thread(
+                    render_pdf_page, str(file_path), image_path, 1, file_hash
+                )
+                if rendered_path:
+                    processing_path = rendered_path
                 else:
                     raise HTTPException(status_code=400, detail="Could not extract pages from PDF")
             except ImportError:
@@ -260,13 +378,9 @@ async def process_visual_questions(file: UploadFile = File(...)):
 
         # Process visual questions
         from .agents.visual_question_agent import process_visual_questions
-        result = await asyncio.to_thread(process_visual_questions, processing_path)
-
-        # Clean up GPU memory
-        import torch
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            logger.info("GPU cache cleared after visual processing")
+        async with VISUAL_GPU_SEM:
+            result = await asyncio.to_thread(process_visual_questions, processing_path)
+        # process_visual_questions already returns cached GPU blocks via agent.reset_cache()
 
         # Add metadata
         result.update({
@@ -282,8 +396,7 @@ async def process_visual_questions(file: UploadFile = File(...)):
         raw_things_dir.mkdir(exist_ok=True)
 
         visual_results_file = raw_things_dir / f"visual_analysis_{file_id[:8]}.json"
-        with open(visual_results_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        write_json_files_in_background([(visual_results_file, result)])
 
         logger.info(f"Visual analysis completed. Found {result.get('total_questions', 0)} questions")
         return result
@@ -3,7 +3,7 @@ Pydantic models for the exam evaluation system.
 """
 
 from pydantic import BaseModel
-from typing import Dict, Optional, List, Any, List
+from typing import Dict, Optional, List, Any
 from datetime import datetime
 
 class SubmissionRequest(BaseModel):
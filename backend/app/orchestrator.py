@@ -6,19 +6,109 @@ Handles both answer sheets and question keys.
 """
 
 import asyncio
+import copy
 import logging
-from typing import Dict, Any
+import os
+import secrets
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional, Set
 from pathlib import Path
 from datetime import datetime
 
+from .utils.file_utils import write_json_files_in_background
+
 logger = logging.getLogger(__name__)
 
+# OCR and question key results keyed by the upload's content hash, so grading the
+# same files again skips the slow stages. Only touched from the event loop.
+STAGE_CACHE_SIZE = int(os.getenv("ORCHESTRATOR_CACHE_SIZE", "64"))
+_stage_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# Fire-and-forget tasks, referenced until done so they aren't garbage collected
+_background_tasks: Set[asyncio.Task] = set()
+
+def _clear_gpu_cache():
+    """Return cached CUDA blocks to the driver once OCR is done with them."""
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        logger.info("GPU cache cleared after OCR processing")
+
+async def _run_cached(cache_key: Optional[str], func: Callable[..., Dict[str, Any]], *args) -> Dict[str, Any]:
+    """Run a stage on a worker thread, or reuse its result for an already seen file."""
+    if cache_key is not None and cache_key in _stage_cache:
+        _stage_cache.move_to_end(cache_key)
+        logger.info(f"Reusing cached result for {cache_key}")
+        return copy.deepcopy(_stage_cache[cache_key])
+
+    result = await asyncio.to_thread(func, *args)
+    # Empty results usually mean the stage failed; let the next submission retry
+    if cache_key is not None and result.get("questions"):
+        _stage_cache[cache_key] = copy.deepcopy(result)
+        while len(_stage_cache) > STAGE_CACHE_SIZE:
+            _stage_cache.popitem(last=False)
+    return result
+
+def _extract_raw_text(file_path: str, answer_sheet: bool) -> str:
+    """Raw text of an uploaded file, saved to raw_things before any parsing."""
+    from .agents.parser_agent import extract_text_from_pdf, extract_text_from_docx
+    ext = Path(file_path).suffix.lower()
+    if ext == '.pdf':
+        return extract_text_from_pdf(file_path)
+    if answer_sheet:
+        # For images, we'll use OCR text as raw text
+        return "Image file - raw text extracted via OCR"
+    if ext == '.docx':
+        return extract_text_from_docx(file_path)
+    return "Unsupported file format"
+
+def _read_question_key(file_path: str, parse_question_text: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Extract the question key text once and parse it. The parsed key carries the
+    raw text along under "raw_text" for raw_things.
+    """
+    text = _extract_raw_text(file_path, answer_sheet=False)
+    parsed = {"subject": "general", "questions": {}}
+    if Path(file_path).suffix.lower() in ('.pdf', '.docx'):
+        try:
+            parsed = parse_question_text(text)
+        except Exception as e:
+            logger.error(f"Question key parsing failed for {file_path}: {e}")
+    else:
+        logger.error(f"Question key parsing failed for {file_path}: unsupported file type")
+    return {"raw_text": text, **parsed}
+
 class Orchestrator:
     def __init__(self):
-        # Agents will be imported here
-        pass
+        # Agent entry points; imported on the first submission, then reused
+        self._agents = None
 
-    async def process_submission(self, answer_sheet_path: str, question_key_path: str) -> Dict[str, Any]:
+    def _load_agents(self) -> Dict[str, Any]:
+        """Import the agent modules once; later submissions reuse the same handles."""
+        if self._agents is None:
+            import sys
+            project_root = Path(__file__).parent.parent.parent
+            if str(project_root) not in sys.path:
+                sys.path.insert(0, str(project_root))
+            from test_ocr_only import process_ocr_only
+            from .agents.parser_agent import parse_question_text
+            from .agents.evaluation_agent_mistral import evaluate_answers
+            from .agents.result_agent import parse_llama_results
+            self._agents = {
+                "process_ocr_only": process_ocr_only,
+                "parse_question_text": parse_question_text,
+                "evaluate_answers": evaluate_answers,
+                "parse_llama_results": parse_llama_results,
+            }
+        return self._agents
+
+    async def process_submission(
+        self,
+        answer_sheet_path: str,
+        question_key_path: str,
+        answer_sheet_hash: Optional[str] = None,
+        question_key_hash: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
         Process an exam submission through the agent pipeline:
         1. Align answer sheet images
@@ -26,92 +116,83 @@ class Orchestrator:
         3. Parse student answers from OCR text
         4. Parse question key from teacher file
         5. Evaluate answers against question key
+        The optional SHA-256 hashes of the uploads let repeat files reuse the
+        cached OCR and question key results.
         """
         try:
             logger.info(f"Starting evaluation for answer sheet: {answer_sheet_path}, question key: {question_key_path}")
 
-            # Extract raw text from answer sheet before processing
-            from .agents.parser_agent import extract_text_from_pdf, extract_text_from_docx
-            from pathlib import Path
-            answer_sheet_ext = Path(answer_sheet_path).suffix.lower()
-            if answer_sheet_ext == '.pdf':
-                raw_answer_sheet_text = extract_text_from_pdf(answer_sheet_path)
-            else:
-                # For images, we'll use OCR text as raw text
-                raw_answer_sheet_text = "Image file - raw text extracted via OCR"
+            agents = self._load_agents()
 
-            # Extract raw text from question key before processing
+            # Raw text extraction, question key parsing and OCR only read their own
+            # input file, so they run concurrently; evaluation waits for all of them
+            answer_sheet_ext = Path(answer_sheet_path).suffix.lower()
             question_key_ext = Path(question_key_path).suffix.lower()
-            if question_key_ext == '.pdf':
-                raw_question_key_text = extract_text_from_pdf(question_key_path)
-            elif question_key_ext == '.docx':
-                raw_question_key_text = extract_text_from_docx(question_key_path)
-            else:
-                raw_question_key_text = "Unsupported file format"
+            raw_answer_sheet_text, question_key_data, ocr_result = await asyncio.gather(
+                asyncio.to_thread(_extract_raw_text, answer_sheet_path, answer_sheet=True),
+                # The key's text is extracted once and both saved raw and parsed
+                _run_cached(
+                    f"qk:{question_key_hash}" if question_key_hash else None,
+                    _read_question_key, question_key_path, agents["parse_question_text"]
+                ),
+                _run_cached(
+                    f"ocr:{answer_sheet_hash}" if answer_sheet_hash else None,
+                    agents["process_ocr_only"], answer_sheet_path
+                )
+            )
+            raw_question_key_text = question_key_data.pop("raw_text")
 
             # Save raw data to raw_things folder
-            import json
-            import uuid
-
             # Use absolute path to raw_things folder from project root
             project_root = Path(__file__).parent.parent.parent
             raw_things_dir = project_root / "raw_things"
             raw_things_dir.mkdir(exist_ok=True)
 
-            submission_id = str(uuid.uuid4())[:8]
+            submission_id = secrets.token_hex(4)
 
-            # Save raw answer sheet text
+            # Raw answer sheet and question key text; these files are debug output,
+            # so they are written in the background while evaluation runs
             raw_answer_sheet_data = {
                 "file_path": answer_sheet_path,
                 "file_type": answer_sheet_ext,
                 "raw_text": raw_answer_sheet_text,
-                "extraction_timestamp": str(datetime.now())
+                "extraction_timestamp": datetime.now()
             }
-            answer_sheet_file = raw_things_dir / f"raw_answer_sheet_{submission_id}.json"
-            with open(answer_sheet_file, 'w', encoding='utf-8') as f:
-                json.dump(raw_answer_sheet_data, f, indent=2, ensure_ascii=False)
-
-            # Save raw question key text
             raw_question_key_data = {
                 "file_path": question_key_path,
                 "file_type": question_key_ext,
                 "raw_text": raw_question_key_text,
-                "extraction_timestamp": str(datetime.now())
+                "extraction_timestamp": datetime.now()
             }
-            question_key_raw_file = raw_things_dir / f"raw_question_key_{submission_id}.json"
-            with open(question_key_raw_file, 'w', encoding='utf-8') as f:
-                json.dump(raw_question_key_data, f, indent=2, ensure_ascii=False)
+            write_json_files_in_background([
+                (raw_things_dir / f"raw_answer_sheet_{submission_id}.json", raw_answer_sheet_data),
+                (raw_things_dir / f"raw_question_key_{submission_id}.json", raw_question_key_data),
+            ])
 
-            # Step 1: Use test_ocr_only for complete OCR processing (includes alignment, OCR, and parsing)
-            import sys
-            from pathlib import Path
-            project_root = Path(__file__).parent.parent.parent
-            if str(project_root) not in sys.path:
-                sys.path.insert(0, str(project_root))
-            from test_ocr_only import process_ocr_only
-            ocr_result = await asyncio.to_thread(process_ocr_only, answer_sheet_path)
+            # Step 1: test_ocr_only did the complete OCR processing (alignment, OCR and parsing)
             student_answers = ocr_result.get("questions", {})
             full_ocr_text = f"OCR processed via test_ocr_only for {len(student_answers)} questions"
 
-            # Clean up GPU memory after OCR processing
-            import torch
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-                logger.info("GPU cache cleared after OCR processing")
+            # Clean up GPU memory after OCR processing, on a worker thread so
+            # evaluation can start talking to Ollama right away
+            cleanup = asyncio.create_task(asyncio.to_thread(_clear_gpu_cache))
+            _background_tasks.add(cleanup)
+            cleanup.add_done_callback(_background_tasks.discard)
 
-            # Step 2: Parse question key
-            from .agents.parser_agent import parse_question_key
-            question_key_data = await asyncio.to_thread(parse_question_key, question_key_path)
+            # Step 2: Question key was parsed alongside OCR
             subject = question_key_data.get("subject", "general")
             question_key = question_key_data.get("questions", {})
 
             # Step 5: Evaluate
-            from .agents.evaluation_agent_mistral import evaluate_answers
-            eval_success = await asyncio.to_thread(evaluate_answers, student_answers, question_key)
+            # Each submission gets its own raw evaluation file; a shared llama_output.txt
+            # would let concurrent submissions read each other's evaluation
+            llama_output_file = raw_things_dir / f"llama_output_{submission_id}.txt"
+            eval_success = await asyncio.to_thread(
+                agents["evaluate_answers"], student_answers, question_key, llama_output_file
+            )
             
             if eval_success:
-                from .agents.result_agent import parse_llama_results
-                evaluation_result = await asyncio.to_thread(parse_llama_results)
+                evaluation_result = await asyncio.to_thread(agents["parse_llama_results"], llama_output_file)
                 
                 # Handle new evaluation format
                 if isinstance(evaluation_result, dict) and 'evaluations' in evaluation_result:
@@ -153,46 +234,26 @@ class Orchestrator:
                 'status': 'success' if eval_success else 'failed'
             }
 
-            # Save parsed data to raw_things folder
-            import json
-            import uuid
-
-            # Use absolute path to raw_things folder from project root
-            project_root = Path(__file__).parent.parent.parent
-            raw_things_dir = project_root / "raw_things"
-            raw_things_dir.mkdir(exist_ok=True)
-
-            submission_id = str(uuid.uuid4())[:8]
-
             # Save parsed data to raw_things folder (using same submission_id)
-            # Save parsed question key
             parsed_question_key_data = {
                 "parsed_data": question_key_data,
-                "parsing_timestamp": str(datetime.now())
+                "parsing_timestamp": datetime.now()
             }
-            parsed_question_key_file = raw_things_dir / f"parsed_question_key_{submission_id}.json"
-            with open(parsed_question_key_file, 'w', encoding='utf-8') as f:
-                json.dump(parsed_question_key_data, f, indent=2, ensure_ascii=False)
-
-            # Save parsed student answers
             parsed_answers_data = {
                 "parsed_answers": student_answers,
-                "parsing_timestamp": str(datetime.now())
+                "parsing_timestamp": datetime.now()
             }
-            parsed_answers_file = raw_things_dir / f"parsed_student_answers_{submission_id}.json"
-            with open(parsed_answers_file, 'w', encoding='utf-8') as f:
-                json.dump(parsed_answers_data, f, indent=2, ensure_ascii=False)
-
-            # Save raw OCR text
             ocr_data = {
                 "raw_ocr_text": full_ocr_text,
-                "ocr_timestamp": str(datetime.now())
+                "ocr_timestamp": datetime.now()
             }
-            ocr_file = raw_things_dir / f"ocr_output_{submission_id}.json"
-            with open(ocr_file, 'w', encoding='utf-8') as f:
-                json.dump(ocr_data, f, indent=2, ensure_ascii=False)
+            write_json_files_in_background([
+                (raw_things_dir / f"parsed_question_key_{submission_id}.json", parsed_question_key_data),
+                (raw_things_dir / f"parsed_student_answers_{submission_id}.json", parsed_answers_data),
+                (raw_things_dir / f"ocr_output_{submission_id}.json", ocr_data),
+            ])
 
-            logger.info(f"Saved all data to raw_things folder with ID: {submission_id}")
+            logger.info(f"Writing all data to raw_things folder with ID: {submission_id}")
             logger.info(f"Evaluation completed. Score: {total_score}/{max_score}")
             return result
 
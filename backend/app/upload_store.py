@@ -0,0 +1,63 @@
+"""
+Registries of uploaded files and background grading jobs, shared between
+workers through Redis when configured.
+"""
+
+import os
+import json
+import logging
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# Uploads and job records are forgotten after this many seconds
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", "86400"))
+
+class UploadStore:
+    def __init__(self, prefix: str = "upload"):
+        self.prefix = prefix
+        self.redis_url = os.getenv("REDIS_URL")
+        self.redis = None
+        # Used when Redis isn't configured or reachable; only visible to this worker
+        self._local: Dict[str, Dict[str, Any]] = {}
+
+    async def connect(self):
+        if not self.redis_url:
+            logger.info(f"REDIS_URL not set. {self.prefix} registry is local to this worker.")
+            return
+        if not aioredis:
+            logger.warning(f"redis not installed. {self.prefix} registry is local to this worker.")
+            return
+        try:
+            self.redis = aioredis.from_url(self.redis_url, decode_responses=True)
+            await self.redis.ping()
+            logger.info(f"Connected to Redis {self.prefix} registry")
+        except Exception as e:
+            logger.warning(f"Redis connection failed: {e}. {self.prefix} registry is local to this worker.")
+            self.redis = None
+
+    async def disconnect(self):
+        if self.redis:
+            await self.redis.close()
+            self.redis = None
+
+    async def set(self, key: str, info: Dict[str, Any]):
+        if not self.redis:
+            self._local[key] = info
+            return
+        await self.redis.set(f"{self.prefix}:{key}", json.dumps(info), ex=UPLOAD_TTL_SECONDS)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.redis:
+            return self._local.get(key)
+        value = await self.redis.get(f"{self.prefix}:{key}")
+        return json.loads(value) if value else None
+
+# Global instances
+uploads = UploadStore()
+jobs = UploadStore(prefix="job")
@@ -2,39 +2,137 @@
 File utilities for handling PDFs and images.
 """
 
+import asyncio
+import json
 import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
 from pathlib import Path
-from typing import List
+from typing import Any, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from pdf2image import convert_from_path
 except ImportError:
     logger.warning("pdf2image not installed. PDF processing disabled.")
     convert_from_path = None
 
+# Poppler renders pages of one document in parallel with this many threads
+PDF_RENDER_THREADS = int(os.getenv("PDF_RENDER_THREADS", str(os.cpu_count() or 1)))
+
+# Rendered page image paths keyed by (content hash, page), so the same PDF
+# uploaded again doesn't go back through Poppler
+RENDERED_PAGE_CACHE_SIZE = 64
+_rendered_pages: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+_rendered_pages_lock = threading.Lock()
+
 def extract_images_from_pdf(pdf_path: str) -> List[str]:
     """
-    Extract images from PDF and save as PNG files.
-    Returns list of image paths.
+    Extract images from PDF and save as PNG files in a new temporary directory
+    (the caller removes it when done). Returns list of image paths.
     """
     if not convert_from_path:
         raise ImportError("pdf2image required for PDF processing")
 
     try:
-        images = convert_from_path(pdf_path)
-        image_paths = []
         pdf_name = Path(pdf_path).stem
-
-        for i, image in enumerate(images):
-            image_path = f"{pdf_name}_page_{i+1}.png"
-            image.save(image_path, "PNG")
-            image_paths.append(image_path)
+        # Poppler writes the PNGs itself; no page is ever held in memory as a PIL image.
+        # Same file prefix as alignment_agent.process_pdf_to_images
+        image_paths = convert_from_path(
+            pdf_path,
+            output_folder=tempfile.mkdtemp(prefix=f"{pdf_name}_pages_"),
+            output_file=f"{pdf_name}_page_",
+            fmt="png",
+            paths_only=True,
+            thread_count=PDF_RENDER_THREADS,
+        )
 
         logger.info(f"Extracted {len(image_paths)} images from {pdf_path}")
         return image_paths
 
     except Exception as e:
         logger.error(f"PDF extraction failed: {e}")
-        return []
\ No newline at end of file
+        return []
+
+def _json_default(value: Any) -> Any:
+    """Match orjson for the types it serializes natively (datetime, numpy)."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def render_pdf_page(pdf_path: str, image_path: Path, page: int = 1, content_hash: Optional[str] = None) -> Optional[str]:
+    """
+    Render a single 1-based PDF page to a JPEG at image_path and return its path,
+    or None if the page doesn't exist. Only that page is rasterized. With
+    `content_hash`, an earlier render of the same file is reused while it exists.
+    """
+    if not convert_from_path:
+        raise ImportError("pdf2image required for PDF processing")
+
+    cache_key = (content_hash, page) if content_hash else None
+    if cache_key:
+        with _rendered_pages_lock:
+            cached = _rendered_pages.get(cache_key)
+        if cached and Path(cached).exists():
+            logger.info(f"Reusing rendered page {page} of {pdf_path}: {cached}")
+            return cached
+
+    pages = convert_from_path(
+        pdf_path, first_page=page, last_page=page, thread_count=PDF_RENDER_THREADS, fmt="jpeg"
+    )
+    if not pages:
+        return None
+    pages[0].save(image_path, "JPEG")
+
+    if cache_key:
+        with _rendered_pages_lock:
+            _rendered_pages[cache_key] = str(image_path)
+            _rendered_pages.move_to_end(cache_key)
+            while len(_rendered_pages) > RENDERED_PAGE_CACHE_SIZE:
+                _rendered_pages.popitem(last=False)
+    return str(image_path)
+
+def write_json_files(files: List[Tuple[Path, Any]]):
+    """
+    Write each (path, data) pair as indented UTF-8 JSON; a failed file doesn't stop the rest.
+    Each file is written beside its target and renamed over it, so readers never see a partial file.
+    """
+    for path, data in files:
+        try:
+            if orjson is not None:
+                payload = orjson.dumps(
+                    data,
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                )
+            else:
+                payload = json.dumps(data, indent=2, ensure_ascii=False, default=_json_default).encode("utf-8")
+            path = Path(path)
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_bytes(payload)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Failed to write {path}: {e}")
+
+# Running background writes; the event loop only keeps weak references to tasks
+_background_writes: Set[asyncio.Task] = set()
+
+def write_json_files_in_background(files: List[Tuple[Path, Any]]) -> asyncio.Task:
+    """
+    Write debug/observability JSON files on a worker thread without waiting for them.
+    The data must not be mutated afterwards.
+    """
+    task = asyncio.create_task(asyncio.to_thread(write_json_files, files))
+    _background_writes.add(task)
+    task.add_done_callback(_background_writes.discard)
+    return task
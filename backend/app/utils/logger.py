@@ -2,27 +2,40 @@
 Centralized logging setup for the backend.
 """
 
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 
 # Create logs directory if it doesn't exist
 logs_dir = Path("logs")
 logs_dir.mkdir(exist_ok=True)
 
-# Configure logging
-logging.basicConfig(
-    filename=logs_dir / "backend.log",
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s:%(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", "50000000"))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+formatter = logging.Formatter("%(asctime)s %(levelname)s:%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
+# Rotate backend.log instead of letting it grow without bound
+file_handler = logging.handlers.RotatingFileHandler(
+    logs_dir / "backend.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
 )
+file_handler.setFormatter(formatter)
 
 # Also log to console
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_formatter = logging.Formatter("%(asctime)s %(levelname)s:%(message)s")
-console_handler.setFormatter(console_formatter)
-logging.getLogger().addHandler(console_handler)
+console_handler.setFormatter(formatter)
+
+# Log calls only enqueue the record; the listener thread does the disk and console writes
+log_queue = queue.Queue(-1)
+listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+listener.start()
+atexit.register(listener.stop)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-logger = logging.getLogger(__name__)
\ No newline at end of file
+logger = logging.getLogger(__name__)
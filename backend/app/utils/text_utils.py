@@ -2,7 +2,6 @@
 Text utilities for cleaning and processing OCR output.
 """
 
-import re
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,15 +11,10 @@ def clean_text(text: str) -> str:
     Clean OCR text: remove extra spaces, fix common OCR errors.
     """
     try:
-        # Remove multiple spaces
-        text = re.sub(r'\s+', ' ', text)
-        # Remove leading/trailing spaces per line
-        lines = [line.strip() for line in text.split('\n')]
-        text = '\n'.join(lines)
-        # Remove empty lines
-        lines = [line for line in lines if line]
-        text = '\n'.join(lines)
-        return text
+        # Collapse runs of spaces within each line (which also strips it) and
+        # drop empty lines; str.split() does this without the regex engine
+        lines = (' '.join(line.split()) for line in text.split('\n'))
+        return '\n'.join([line for line in lines if line])
     except Exception as e:
         logger.error(f"Text cleaning failed: {e}")
         return text
\ No newline at end of file
@@ -8,17 +8,70 @@ Using Qwen-VL-2B-Instruct — tuned for math, diagrams, and hybrid exam layouts.
 """
 
 import os
+import re
 import sys
 import json
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 from PIL import Image
 import torch
-from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, Qwen2VLProcessor
+from transformers import Qwen2VLForConditionalGeneration, Qwen2VLProcessor
 
 logger = logging.getLogger(__name__)
 
+# Question header line (Q1., Question 2:, (3), 4. ...); compiled once and
+# scanned over the whole OCR buffer. Group 1 is the stripped header line,
+# group 2 the question number.
+_QUESTION_HEADER_RE = re.compile(
+    r"^[^\S\n]*((?:Q|Question)?[^\S\n]*\(?(\d+)\)?[\.:)].*?)[^\S\n]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+# Full-coverage OCR prompt, built once; non-science subjects get the same
+# rules under a general heading
+MATH_OCR_PROMPT = """<|system|>
+You are a **precision OCR system** for exam sheets containing handwritten and printed text, equations, and diagrams.
+Your job is to **transcribe everything visible**, with 100% completeness — do NOT omit or summarize any content.
+
+-----------------------------------------------------
+🔹 RULES
+-----------------------------------------------------
+- Transcribe all visible text exactly as written.
+- Include printed & handwritten text, symbols, equations, and labels.
+- Keep original question numbering: Q1, Q2), (a), (i), etc.
+- Include every subheading like “Definition:”, “Formula:”, etc.
+- Retain all bullet marks (*, •, →, ✯, -).
+- Preserve line spacing, indentation, and blank lines.
+- If unclear: use “[illegible]”.
+- If a diagram or table is present:  
+  Write: [Diagram: short description] or [Table: X rows × Y columns]
+- Do NOT skip any corner, margin, or faint handwriting.
+- Every new line in the image = new line in output.
+- Never rephrase, interpret, or correct errors.
+
+-----------------------------------------------------
+🔹 MATH-SPECIFIC RULES
+-----------------------------------------------------
+- Use Unicode math symbols: ², ³, √, ∑, ∫, ±, ×, ÷, ≤, ≥, ≠, ≈, ∞, α, β, π, θ, λ.
+- Preserve spacing and inline layout:  
+  Example: “F = m × a”, “E = mc²”
+- Do not change notation or use LaTeX.
+- Each math line stays as a separate line.
+
+-----------------------------------------------------
+🔹 OUTPUT FORMAT
+-----------------------------------------------------
+- Output only plain text transcription.
+- Each question begins on a new line and is separated by one blank line.
+- Do NOT output commentary or examples.
+- Ensure full page coverage — if any visible text exists, it must appear in output.
+"""
+GENERAL_OCR_PROMPT = MATH_OCR_PROMPT.replace("MATH-SPECIFIC RULES", "GENERAL RULES")
+
+_MATH_KEYWORDS = ("math", "physics", "chemistry", "science")
+
 
 class OCREngine:
     def __init__(self, model_name: str = os.getenv("OCR_MODEL", "Qwen/Qwen2-VL-2B-Instruct")):
@@ -28,14 +81,21 @@ class OCREngine:
         self.device = torch.device("cuda")
         logger.info(f"Using GPU device: {self.device}")
 
+        # Rendered chat templates keyed by prompt text
+        self._chat_text_cache: Dict[str, str] = {}
+
         try:
             self.model = Qwen2VLForConditionalGeneration.from_pretrained(
                 model_name,
                 torch_dtype=torch.float16,
-                device_map="auto"
+                device_map="auto",
+                low_cpu_mem_usage=True,
+                use_safetensors=True
             )
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.processor = Qwen2VLProcessor.from_pretrained(model_name, use_fast=False)
+            self.model.eval()
+            self.processor = Qwen2VLProcessor.from_pretrained(model_name, use_fast=True)
+            # Batched tiles need left padding so every prompt ends where generation starts
+            self.processor.tokenizer.padding_side = "left"
             logger.info("OCR model loaded successfully.")
         except Exception as e:
             logger.error(f"Model loading failed: {e}")
@@ -68,43 +128,72 @@ class OCREngine:
     # Core OCR Generation Pass
     # -------------------------------------------------------------------------
     def _run_ocr_once(self, image: Image.Image, prompt: str) -> str:
-        messages = [{"role": "user", "content": [
-            {"type": "text", "text": prompt},
-            {"type": "image", "image": image}
-        ]}]
-
-        text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = self.processor(text=text, images=image, return_tensors="pt").to(self.device)
-
-        with torch.no_grad():
-            generated_ids = self.model.generate(**inputs, max_new_tokens=4096, do_sample=False)
-
-        generated_ids_trimmed = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
-        output_text = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True)[0]
-        return output_text.strip()
+        return self._run_ocr_batch([image], prompt)[0]
+
+    def _run_ocr_batch(self, images: List[Image.Image], prompt: str) -> List[str]:
+        """One padded generate call over several images sharing the same prompt."""
+        text = self._get_chat_text(prompt)
+        inputs = self.processor(
+            text=[text] * len(images), images=images, return_tensors="pt", padding=True
+        ).to(self.device)
+
+        with torch.inference_mode():
+            generated_ids = self.model.generate(**inputs, max_new_tokens=4096, do_sample=False, use_cache=True)
+
+        # With left padding every row's prompt has the same padded length
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        output_texts = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True)
+        return [output_text.strip() for output_text in output_texts]
+
+    def _get_chat_text(self, prompt: str) -> str:
+        """
+        Return the chat-templated text for a prompt, rendering each prompt once.
+        The image placeholder is the same for every image; the processor expands it.
+        """
+        text = self._chat_text_cache.get(prompt)
+        if text is None:
+            messages = [{"role": "user", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image"}
+            ]}]
+            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            self._chat_text_cache[prompt] = text
+        return text
 
     # -------------------------------------------------------------------------
     # Retry by Tiling Image (splitting vertically to avoid cutoff)
     # -------------------------------------------------------------------------
     def _tile_and_retry(self, image: Image.Image, prompt: str) -> str:
         width, height = image.size
-        segments = []
         num_tiles = 3 if height > 1800 else 2  # adaptive tiling
         tile_height = height // num_tiles
 
+        tiles = []
         for i in range(num_tiles):
             y0 = i * tile_height
             y1 = height if i == num_tiles - 1 else (i + 1) * tile_height
-            tile = image.crop((0, y0, width, y1))
-            logger.info(f"Processing tile {i+1}/{num_tiles} for full coverage.")
-            try:
-                part_text = self._run_ocr_once(tile, prompt)
-                if part_text:
-                    segments.append(part_text)
-            except Exception as e:
-                logger.error(f"Tile {i+1} OCR failed: {e}")
-
-        merged = "\n\n".join(segments)
+            tiles.append(image.crop((0, y0, width, y1)))
+
+        # All tiles go through one generate call; if that fails (e.g. doesn't fit
+        # in VRAM), fall back to one tile at a time so good tiles aren't lost
+        logger.info(f"Processing {num_tiles} tiles in one batch for full coverage.")
+        try:
+            segments = self._run_ocr_batch(tiles, prompt)
+        except Exception as e:
+            if isinstance(e, torch.cuda.OutOfMemoryError):
+                logger.warning("Tile batch ran out of GPU memory. Processing tiles one at a time.")
+                torch.cuda.empty_cache()
+            else:
+                logger.warning(f"Tile batch OCR failed: {e}. Processing tiles one at a time.")
+            segments = []
+            for i, tile in enumerate(tiles):
+                logger.info(f"Processing tile {i+1}/{num_tiles} for full coverage.")
+                try:
+                    segments.append(self._run_ocr_once(tile, prompt))
+                except Exception as e:
+                    logger.error(f"Tile {i+1} OCR failed: {e}")
+
+        merged = "\n\n".join(part_text for part_text in segments if part_text)
         return merged
 
     # -------------------------------------------------------------------------
@@ -112,50 +201,9 @@ class OCREngine:
     # -------------------------------------------------------------------------
     def _get_subject_prompt(self, subject: str) -> str:
         subject_lower = subject.lower()
-        math_keywords = ["math", "physics", "chemistry", "science"]
-
-        base_prompt = """<|system|>
-You are a **precision OCR system** for exam sheets containing handwritten and printed text, equations, and diagrams.
-Your job is to **transcribe everything visible**, with 100% completeness — do NOT omit or summarize any content.
-
------------------------------------------------------
-🔹 RULES
------------------------------------------------------
-- Transcribe all visible text exactly as written.
-- Include printed & handwritten text, symbols, equations, and labels.
-- Keep original question numbering: Q1, Q2), (a), (i), etc.
-- Include every subheading like “Definition:”, “Formula:”, etc.
-- Retain all bullet marks (*, •, →, ✯, -).
-- Preserve line spacing, indentation, and blank lines.
-- If unclear: use “[illegible]”.
-- If a diagram or table is present:  
-  Write: [Diagram: short description] or [Table: X rows × Y columns]
-- Do NOT skip any corner, margin, or faint handwriting.
-- Every new line in the image = new line in output.
-- Never rephrase, interpret, or correct errors.
-
------------------------------------------------------
-🔹 MATH-SPECIFIC RULES
------------------------------------------------------
-- Use Unicode math symbols: ², ³, √, ∑, ∫, ±, ×, ÷, ≤, ≥, ≠, ≈, ∞, α, β, π, θ, λ.
-- Preserve spacing and inline layout:  
-  Example: “F = m × a”, “E = mc²”
-- Do not change notation or use LaTeX.
-- Each math line stays as a separate line.
-
------------------------------------------------------
-🔹 OUTPUT FORMAT
------------------------------------------------------
-- Output only plain text transcription.
-- Each question begins on a new line and is separated by one blank line.
-- Do NOT output commentary or examples.
-- Ensure full page coverage — if any visible text exists, it must appear in output.
-"""
-
-        if any(k in subject_lower for k in math_keywords):
-            return base_prompt
-        else:
-            return base_prompt.replace("MATH-SPECIFIC RULES", "GENERAL RULES")
+        if any(k in subject_lower for k in _MATH_KEYWORDS):
+            return MATH_OCR_PROMPT
+        return GENERAL_OCR_PROMPT
 
     # -------------------------------------------------------------------------
     # Folder processor (batch)
@@ -178,27 +226,17 @@ Your job is to **transcribe everything visible**, with 100% completeness — do
     # Parser — keeps question/answer mapping for evaluation
     # -------------------------------------------------------------------------
     def parse_exam_output(self, ocr_text: str) -> Dict[str, str]:
-        import re
         structured = {}
-        lines = ocr_text.split('\n')
-        current_q = None
-        buffer = []
-
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-
-            if re.match(r'^(?:Q|Question)?\s*\(?\d+\)?[\.:)]', line, re.IGNORECASE):
-                if current_q is not None:
-                    structured[str(current_q)] = '\n'.join(buffer).strip()
-                qnum_match = re.search(r'\d+', line)
-                current_q = qnum_match.group(0) if qnum_match else len(structured) + 1
-                buffer = [line]
-            else:
-                buffer.append(line)
 
-        if current_q is not None:
-            structured[str(current_q)] = '\n'.join(buffer).strip()
+        matches = list(_QUESTION_HEADER_RE.finditer(ocr_text))
+        for index, header in enumerate(matches):
+            # Body runs until the next header (or the end of the text);
+            # body lines are stripped and filtered with C-level map/filter
+            body_end = matches[index + 1].start() if index + 1 < len(matches) else len(ocr_text)
+            body_lines = ocr_text[header.end():body_end].split('\n')
+
+            buffer = [header.group(1)]
+            buffer.extend(filter(None, map(str.strip, body_lines)))
+            structured[header.group(2)] = '\n'.join(buffer)
 
         return structured
@@ -1,8 +1,13 @@
 import requests
 
+# One session so the upload reuses the keep-alive connection from the first check;
+# (connect, read) timeouts keep the probe from hanging on a stuck backend
+session = requests.Session()
+TIMEOUT = (3, 30)
+
 # Test backend connection
 try:
-    response = requests.get('http://localhost:8000/docs')
+    response = session.get('http://localhost:8000/docs', timeout=TIMEOUT)
     if response.status_code == 200:
         print("✅ Backend is running and accessible!")
         print("📋 API Documentation available at: http://localhost:8000/docs")
@@ -17,7 +22,7 @@ test_file_path = r"A:\progash\ocr\sample_images\realtest.jpeg"
 try:
     with open(test_file_path, 'rb') as f:
         files = {'file': ('realtest.jpeg', f, 'image/jpeg')}
-        response = requests.post('http://localhost:8000/upload/answer_sheet', files=files)
+        response = session.post('http://localhost:8000/upload/answer_sheet', files=files, timeout=TIMEOUT)
 
     if response.status_code == 200:
         data = response.json()
@@ -1,34 +1,121 @@
 import sys
 import os
 import json
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
 
 from app.agents.evaluation_agent_llama import evaluate_answers
 from app.agents.result_agent import parse_llama_results
 
+ASSESSMENT_MODEL = 'mistral'
+# How long Ollama keeps the assessment model in VRAM after each request
+ASSESSMENT_KEEP_ALIVE = os.getenv("ASSESSMENT_KEEP_ALIVE", "30m")
+
+# Assessments keyed by SHA-256 of model + prompt; the prompt embeds the OCR text,
+# question key and parsed answers, so unchanged inputs skip the LLM on later runs
+ASSESSMENT_CACHE_DIR = Path(os.getenv("ASSESSMENT_CACHE_DIR", "assessment_cache"))
+_assessment_cache = {}
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Opt-in near-duplicate reuse: with ASSESSMENT_SEMANTIC_THRESHOLD set (e.g. 0.92), inputs
+# whose MiniLM embedding has at least that cosine similarity to cached inputs reuse their
+# assessment. Off by default: a small parsing change may be exactly what should be assessed.
+SEMANTIC_THRESHOLD = float(os.getenv("ASSESSMENT_SEMANTIC_THRESHOLD") or 0)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# MiniLM truncates at 256 word pieces, so longer inputs are embedded in chunks and averaged
+EMBEDDING_CHUNK_WORDS = 150
+_embedder = None
+_semantic_entries = None  # cache key -> normalized embedding, loaded from disk on first use
+
+def _embed(text):
+    global _embedder
+    if _embedder is None:
+        _embedder = SentenceTransformer(EMBEDDING_MODEL)
+    words = text.split() or [""]
+    chunks = [" ".join(words[i:i + EMBEDDING_CHUNK_WORDS]) for i in range(0, len(words), EMBEDDING_CHUNK_WORDS)]
+    vector = _embedder.encode(chunks, normalize_embeddings=True).mean(axis=0)
+    return vector / np.linalg.norm(vector)
+
+def _semantic_lookup(vector):
+    """Return (cache key, similarity) of the closest cached assessment, or (None, 0.0)."""
+    global _semantic_entries
+    if _semantic_entries is None:
+        _semantic_entries = {path.stem: np.load(path) for path in ASSESSMENT_CACHE_DIR.glob("*.npy")}
+    if not _semantic_entries:
+        return None, 0.0
+    keys = list(_semantic_entries)
+    # Inner product of normalized vectors is cosine similarity (what IndexFlatIP computes)
+    similarities = np.stack([_semantic_entries[key] for key in keys]) @ vector
+    best = int(similarities.argmax())
+    return keys[best], float(similarities[best])
+
+def _compact_json(value):
+    """Serialize without indentation; the whitespace would only cost the LLM prompt tokens."""
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def _warm_up_assessment_model():
+    """Start loading the assessment model into Ollama in the background."""
+    def load():
+        try:
+            import ollama
+            # An empty prompt loads the model without generating anything
+            ollama.generate(model=ASSESSMENT_MODEL, prompt='', keep_alive=ASSESSMENT_KEEP_ALIVE)
+        except Exception as e:
+            print(f"Assessment model warmup failed: {e}")
+
+    threading.Thread(target=load, daemon=True).start()
+
+def _load_json_item(path, prefix):
+    """Return the value at a dotted prefix (e.g. "parsed_data.questions") of a JSON file."""
+    if ijson is not None:
+        # Parses only up to the requested subtree instead of building the whole document
+        with open(path, 'rb') as f:
+            return next(ijson.items(f, prefix, use_float=True))
+    with open(path, 'r') as f:
+        value = json.load(f)
+    for key in prefix.split('.'):
+        value = value[key]
+    return value
+
 def test_evaluation_only():
     print("Testing evaluation only...")
+    # Model weights load while the inputs are read, instead of inside the first assessment call
+    _warm_up_assessment_model()
 
     # Load the parsed data from raw_things
     submission_id = "4b0098ef"  # From the files we saw
 
     try:
         # Load OCR output
-        with open(f"raw_things/ocr_output_{submission_id}.json", 'r') as f:
-            ocr_data = json.load(f)
-        raw_ocr_text = ocr_data["raw_ocr_text"]
+        raw_ocr_text = _load_json_item(f"raw_things/ocr_output_{submission_id}.json", "raw_ocr_text")
         print(f"Loaded OCR text (first 200 chars): {raw_ocr_text[:200]}...")
 
         # Load student answers
-        with open(f"raw_things/parsed_student_answers_{submission_id}.json", 'r') as f:
-            student_data = json.load(f)
-        student_answers = student_data["parsed_answers"]
+        student_answers = _load_json_item(f"raw_things/parsed_student_answers_{submission_id}.json", "parsed_answers")
         print(f"Loaded student answers: {list(student_answers.keys())}")
 
         # Load question key
-        with open(f"raw_things/parsed_question_key_{submission_id}.json", 'r') as f:
-            question_data = json.load(f)
-        question_key = question_data["parsed_data"]["questions"]
+        question_key = _load_json_item(f"raw_things/parsed_question_key_{submission_id}.json", "parsed_data.questions")
         print(f"Loaded question key: {list(question_key.keys())}")
 
         # Convert student_answers keys to match question_key format (add Q prefix if needed)
@@ -43,7 +130,7 @@ def test_evaluation_only():
 
         # First, let's evaluate the parsing accuracy with LLM
         print("\n=== EVALUATING OCR PARSING ACCURACY ===")
-        evaluate_parsing_accuracy(raw_ocr_text, question_key, converted_answers)
+        asyncio.run(evaluate_parsing_accuracy(raw_ocr_text, question_key, converted_answers))
 
         # Then run the actual answer evaluation
         print("\n=== EVALUATING STUDENT ANSWERS ===")
@@ -62,8 +149,9 @@ def test_evaluation_only():
         import traceback
         traceback.print_exc()
 
-def evaluate_parsing_accuracy(raw_ocr_text, question_key, student_answers):
-    """Use LLM to evaluate if the OCR parsing is accurate"""
+async def evaluate_parsing_accuracy(raw_ocr_text, question_key, student_answers,
+                                    output_path="parsing_accuracy_assessment.txt"):
+    """Use LLM to evaluate if the OCR parsing is accurate. Returns the assessment, or None on failure."""
     try:
         import ollama
 
@@ -85,33 +173,77 @@ Raw OCR Text:
 {raw_ocr_text}
 
 Expected Questions:
-{json.dumps(question_key, indent=2)}
+{_compact_json(question_key)}
 
 Parsed Student Answers:
-{json.dumps(student_answers, indent=2)}
+{_compact_json(student_answers)}
 
 Provide a detailed assessment of the parsing accuracy. Score it from 1-10 and explain any issues.
 """
 
-        print("Evaluating parsing accuracy with LLM...")
-        response = ollama.chat(
-            model='mistral',
-            messages=[{'role': 'user', 'content': prompt}],
-            options={'temperature': 0.2, 'timeout': 60}
-        )
+        cache_key = hashlib.sha256(f"{ASSESSMENT_MODEL}\n{prompt}".encode("utf-8")).hexdigest()
+        cache_file = ASSESSMENT_CACHE_DIR / f"{cache_key}.txt"
+        assessment = _assessment_cache.get(cache_key)
+        if assessment is None and cache_file.exists():
+            assessment = cache_file.read_text(encoding="utf-8")
+
+        vector = None
+        if assessment is None and SEMANTIC_THRESHOLD and SentenceTransformer is not None:
+            # Only the variable inputs are embedded; the instructions are identical every time
+            vector = _embed("\n".join([
+                raw_ocr_text,
+                json.dumps(question_key, sort_keys=True),
+                json.dumps(student_answers, sort_keys=True),
+            ]))
+            similar_key, similarity = _semantic_lookup(vector)
+            similar_file = ASSESSMENT_CACHE_DIR / f"{similar_key}.txt"
+            if similar_key and similarity >= SEMANTIC_THRESHOLD and similar_file.exists():
+                print(f"Reusing assessment for near-identical inputs (similarity {similarity:.3f})")
+                assessment = similar_file.read_text(encoding="utf-8")
+
+        if assessment is not None:
+            print("Using cached parsing accuracy assessment")
+        else:
+            print("Evaluating parsing accuracy with LLM...")
+            # Async client so several assessments can wait on the server together
+            response = await ollama.AsyncClient().chat(
+                model=ASSESSMENT_MODEL,
+                messages=[{'role': 'user', 'content': prompt}],
+                options={'temperature': 0.2, 'timeout': 60},
+                keep_alive=ASSESSMENT_KEEP_ALIVE
+            )
+            assessment = response['message']['content'].strip()
+            ASSESSMENT_CACHE_DIR.mkdir(exist_ok=True, parents=True)
+            cache_file.write_text(assessment, encoding="utf-8")
+            if vector is not None:
+                np.save(ASSESSMENT_CACHE_DIR / f"{cache_key}.npy", vector)
+                _semantic_entries[cache_key] = vector
+        _assessment_cache[cache_key] = assessment
 
-        assessment = response['message']['content'].strip()
         print("Parsing Accuracy Assessment:")
         print(assessment)
 
         # Save assessment
-        with open("parsing_accuracy_assessment.txt", 'w', encoding='utf-8') as f:
+        with open(output_path, 'w', encoding='utf-8') as f:
             f.write(assessment)
 
-        print("Assessment saved to parsing_accuracy_assessment.txt")
+        print(f"Assessment saved to {output_path}")
+        return assessment
 
     except Exception as e:
         print(f"Parsing evaluation failed: {e}")
+        return None
+
+async def gather_assessments(batches):
+    """
+    Run parsing assessments for several (raw_ocr_text, question_key, student_answers)
+    tuples concurrently; results are in input order. Start the Ollama server with
+    OLLAMA_NUM_PARALLEL >= len(batches) or the requests queue up server-side.
+    """
+    return await asyncio.gather(*[
+        evaluate_parsing_accuracy(*batch, output_path=f"parsing_accuracy_assessment_{index}.txt")
+        for index, batch in enumerate(batches, 1)
+    ])
 
 if __name__ == "__main__":
     test_evaluation_only()
\ No newline at end of file
@@ -5,6 +5,7 @@ Tests the visual question processing without the full web interface.
 
 import sys
 import os
+from functools import lru_cache
 from pathlib import Path
 
 # Add the backend app to the path
@@ -47,22 +48,27 @@ def test_visual_processing_function():
         print(f"❌ Visual processing function test failed: {e}")
         return False
 
+@lru_cache(maxsize=8)
+def _font(size):
+    """Arial at `size`, or PIL's default font if it isn't installed; looked up once per size."""
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
 def create_sample_visual_question():
     """Create a simple sample visual question for testing."""
     try:
-        from PIL import Image, ImageDraw, ImageFont
+        from PIL import Image, ImageDraw
         
         # Create a sample image with a simple visual question
         img = Image.new('RGB', (800, 600), color='white')
         draw = ImageDraw.Draw(img)
         
         # Try to use a default font, fallback to basic if not available
-        try:
-            font_large = ImageFont.truetype("arial.ttf", 24)
-            font_medium = ImageFont.truetype("arial.ttf", 18)
-        except:
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
+        font_large = _font(24)
+        font_medium = _font(18)
         
         # Draw a simple question
         draw.text((50, 50), "Question 1: How many circles are in the image below?", fill='black', font=font_large)
@@ -1,12 +1,63 @@
 import sys
 import os
+import hashlib
+import logging
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
 
-from app.agents.ocr_agent_qwen import OCREngine
+from app.agents.ocr_agent_qwen import get_engine
 from app.agents.parser_agent import extract_text_from_pdf
 from app.agents.alignment_agent import process_pdf_to_images
+from app.utils.file_utils import write_json_files
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Rendered pages keyed by PDF path + mtime + size, so rerunning the test on an unchanged PDF
+# skips rasterizing. Only test_ocr_only() uses it: process_ocr_only serves uploads, which
+# have unique names and would never hit the cache
+PDF_PAGE_CACHE_DIR = Path(os.getenv("PDF_PAGE_CACHE_DIR", Path(__file__).parent / "cache" / "pdf_pages"))
+
+# Whitespace around each newline; collapsing it to one "\n" strips every line and drops blank ones
+_LINE_BREAK_RE = re.compile(r"\s*\n\s*")
+
+def _cached_pdf_pages(pdf_path: str) -> List[str]:
+    """Return page image paths for a PDF, rendering it only if it changed since the last run."""
+    abs_path = os.path.abspath(pdf_path)
+    key = f"{abs_path}:{os.path.getmtime(abs_path)}:{os.path.getsize(abs_path)}"
+    cache_dir = PDF_PAGE_CACHE_DIR / hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    if cache_dir.is_dir():
+        logger.info(f"Using cached page images from {cache_dir}")
+        return [str(path) for path in sorted(cache_dir.glob("page_*"))]
+
+    image_paths = process_pdf_to_images(pdf_path)
+    if not image_paths:
+        return image_paths
+
+    # Copy into a temporary folder and rename it, so an interrupted run never leaves a partial cache
+    tmp_dir = cache_dir.with_name(cache_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for i, image_path in enumerate(image_paths, 1):
+        shutil.copyfile(image_path, tmp_dir / f"page_{i:04d}{Path(image_path).suffix}")
+    tmp_dir.rename(cache_dir)
+    return [str(path) for path in sorted(cache_dir.glob("page_*"))]
+
+def _load_engine_and_pages(pdf_path: str, use_page_cache: bool = False):
+    """
+    Load the OCR engine and rasterize the PDF at the same time; returns (engine, image paths).
+    `use_page_cache` reuses pages rendered by an earlier run on the same unchanged file.
+    """
+    render_pages = _cached_pdf_pages if use_page_cache else process_pdf_to_images
+    # Model loading is mostly GPU/disk work and page rendering runs in pdfium/Poppler,
+    # so neither holds the GIL for long and the shorter one is hidden behind the other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        engine_future = executor.submit(get_engine)
+        pages_future = executor.submit(render_pages, pdf_path)
+        return engine_future.result(), pages_future.result()
 
 def process_ocr_only(pdf_path: str) -> Dict[str, str]:
     """
@@ -16,20 +67,13 @@ def process_ocr_only(pdf_path: str) -> Dict[str, str]:
     print(f"Processing OCR for: {pdf_path}")
 
     try:
-        # Initialize OCR engine
-        ocr_engine = OCREngine()
-
-        # Convert PDF to images
-        from app.agents.alignment_agent import process_pdf_to_images
-        image_paths = process_pdf_to_images(pdf_path)
+        # Shared OCR engine (model loads once per process) and the PDF's page images
+        ocr_engine, image_paths = _load_engine_and_pages(pdf_path)
         print(f"Found {len(image_paths)} pages")
 
-        # OCR each page and accumulate all questions
-        all_ocr_texts = []
-        for i, img_path in enumerate(image_paths):
-            print(f"OCR processing page {i+1}: {img_path}")
-            ocr_text = ocr_engine.ocr_handwriting(img_path, "physics")
-            all_ocr_texts.append(ocr_text)
+        # OCR all pages in batched generate calls; texts come back in page order
+        print(f"OCR processing {len(image_paths)} pages")
+        all_ocr_texts = ocr_engine.ocr_handwriting_batch(image_paths, "physics")
 
         # Combine all pages into one document
         full_ocr_text = '\n\n'.join(all_ocr_texts)
@@ -41,30 +85,14 @@ def process_ocr_only(pdf_path: str) -> Dict[str, str]:
         # Optional: Save to JSON files (can be disabled if not needed)
         _save_ocr_results(student_answers, pdf_path)
 
-        # Clean up GPU memory
-        import torch
-        import gc
-        if hasattr(ocr_engine, 'model'):
-            del ocr_engine.model
-        if hasattr(ocr_engine, 'tokenizer'):
-            del ocr_engine.tokenizer
-        if hasattr(ocr_engine, 'processor'):
-            del ocr_engine.processor
-        del ocr_engine
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
-        print("GPU memory cleaned up after OCR processing")
-
         return {"questions": student_answers}
 
     except Exception as e:
         print(f"OCR processing failed: {e}")
         raise
 
-def _save_ocr_results(student_answers: Dict[str, str], pdf_path: str):
-    """Save parsed answers to JSON files."""
-    import json
+def _save_ocr_results(student_answers: Dict[str, str], pdf_path: str) -> Path:
+    """Save parsed answers to one JSON file per question and return their folder."""
     import uuid
     
     correct_ocr_dir = Path(__file__).parent / "backend" / "correct_ocr"
@@ -76,21 +104,19 @@ def _save_ocr_results(student_answers: Dict[str, str], pdf_path: str):
     pdf_folder = correct_ocr_dir / f"{pdf_name}_{submission_id}"
     pdf_folder.mkdir(exist_ok=True, parents=True)
     
+    # Build every file first, then write them in one pass (orjson when installed)
+    files = []
     for question_num, answer_text in student_answers.items():
-        answer_lines = [line.strip() for line in answer_text.split('\n') if line.strip()]
-        clean_answer = '\n'.join(answer_lines)
-        
         question_data = {
             "question_number": question_num,
-            "Answer": clean_answer,
+            "Answer": _LINE_BREAK_RE.sub('\n', answer_text).strip(),
             "pdf_file": str(pdf_path)
         }
-        
-        question_file = pdf_folder / f"question_{question_num}.json"
-        with open(question_file, 'w', encoding='utf-8') as f:
-            json.dump(question_data, f, indent=2, ensure_ascii=False)
-        
-        print(f"Saved question {question_num} to {question_file}")
+        files.append((pdf_folder / f"question_{question_num}.json", question_data))
+    write_json_files(files)
+
+    print(f"Saved {len(files)} questions to {pdf_folder}")
+    return pdf_folder
 
 def test_ocr_only():
     # Test OCR extraction only
@@ -109,31 +135,18 @@ def test_ocr_only():
             raw_text = extract_text_from_pdf(answer_sheet)
             print(f"Raw PDF text: {raw_text[:200]}...")
 
-        # Initialize OCR engine
-        print("Initializing OCR engine...")
-        ocr_engine = OCREngine()
-
-        # For PDF, we need to convert to images first
-        from app.agents.alignment_agent import process_pdf_to_images
-
-        print("Converting PDF to images...")
-        image_paths = process_pdf_to_images(answer_sheet)
+        # Initialize OCR engine; for PDF, we need to convert to images first
+        print("Initializing OCR engine and converting PDF to images...")
+        ocr_engine, image_paths = _load_engine_and_pages(answer_sheet, use_page_cache=True)
 
         print(f"Found {len(image_paths)} pages")
 
-        # Create correct_ocr directory
-        correct_ocr_dir = Path(__file__).parent / "backend" / "correct_ocr"
-        correct_ocr_dir.mkdir(exist_ok=True, parents=True)
-
         # OCR each page and accumulate all questions
         print("\nProcessing all pages and accumulating questions...")
         
-        all_ocr_texts = []
-        for i, img_path in enumerate(image_paths):
-            print(f"OCR processing page {i+1}: {img_path}")
-            ocr_text = ocr_engine.ocr_handwriting(img_path, "physics")
-            print(f"OCR Result page {i+1}: {ocr_text[:300]}...")
-            all_ocr_texts.append(ocr_text)
+        all_ocr_texts = ocr_engine.ocr_handwriting_batch(image_paths, "physics")
+        for i, (img_path, ocr_text) in enumerate(zip(image_paths, all_ocr_texts)):
+            print(f"OCR Result page {i+1} ({img_path}): {ocr_text[:300]}...")
 
         # Combine all pages into one document
         full_ocr_text = '\n\n'.join(all_ocr_texts)
@@ -143,34 +156,7 @@ def test_ocr_only():
         student_answers = ocr_engine.parse_exam_output(full_ocr_text)
         print(f"Found {len(student_answers)} questions total: {list(student_answers.keys())}")
 
-        import json
-        import uuid
-        from datetime import datetime
-
-        submission_id = str(uuid.uuid4())[:8]
-        pdf_name = Path(answer_sheet).stem.replace(' ', '_')  # Clean filename for folder
-
-        # Create subfolder for this PDF
-        pdf_folder = correct_ocr_dir / f"{pdf_name}_{submission_id}"
-        pdf_folder.mkdir(exist_ok=True, parents=True)
-
-        # Save each question as separate JSON file
-        for question_num, answer_text in student_answers.items():
-            # Preserve newlines in the answer
-            answer_lines = [line.strip() for line in answer_text.split('\n') if line.strip()]
-            clean_answer = '\n'.join(answer_lines)
-
-            question_data = {
-                "question_number": question_num,
-                "Answer": clean_answer,
-                "pdf_file": str(answer_sheet)
-            }
-
-            question_file = pdf_folder / f"question_{question_num}.json"
-            with open(question_file, 'w', encoding='utf-8') as f:
-                json.dump(question_data, f, indent=2, ensure_ascii=False)
-
-            print(f"Saved question {question_num} to {question_file}")
+        pdf_folder = _save_ocr_results(student_answers, answer_sheet)
 
         print(f"\n✅ OCR test completed successfully! Found {len(student_answers)} questions total across {len(image_paths)} pages.")
         print(f"Results saved to {pdf_folder}")
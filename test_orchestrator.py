@@ -1,28 +1,60 @@
 import asyncio
 import sys
 import os
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), 'backend'))
 
 from app.orchestrator import Orchestrator
 
-async def test_orchestrator():
-    # Test with the uploaded files - use actual files from uploads directory
-    answer_sheet = r"A:\progash\gg\ans phy.pdf"
-    question_key = r"A:\progash\ocr\backend\uploads\d763d97b-be18-429d-8441-06be04d19205_question_key.pdf"
+# Default submission when no files are given on the command line
+DEFAULT_PAIRS = [(
+    r"A:\progash\gg\ans phy.pdf",
+    r"A:\progash\ocr\backend\uploads\d763d97b-be18-429d-8441-06be04d19205_question_key.pdf",
+)]
 
-    print(f"Testing with files:")
-    print(f"Answer sheet: {answer_sheet}")
-    print(f"Question key: {question_key}")
+# Submissions in flight at once; match the Ollama server's OLLAMA_NUM_PARALLEL
+CONCURRENCY = int(os.getenv("OLLAMA_NUM_PARALLEL", "2"))
 
-    try:
-        orchestrator = Orchestrator()
-        result = await orchestrator.process_submission(answer_sheet, question_key)
-        print("✅ Processing successful!")
-        print(f"Result: {result}")
-    except Exception as e:
-        print(f"❌ Processing failed: {e}")
-        import traceback
-        traceback.print_exc()
+async def run_submission(orchestrator, semaphore, index, answer_sheet, question_key):
+    async with semaphore:
+        print(f"[{index}] Answer sheet: {answer_sheet}")
+        print(f"[{index}] Question key: {question_key}")
+        start = time.monotonic()
+        try:
+            result = await orchestrator.process_submission(answer_sheet, question_key)
+            # process_submission reports its own failures as {'status': 'failed', ...}
+            if result.get('status') == 'success':
+                print(f"✅ [{index}] Processing successful in {time.monotonic() - start:.1f}s")
+            else:
+                print(f"❌ [{index}] Processing failed after {time.monotonic() - start:.1f}s: {result.get('error', 'evaluation failed')}")
+            print(f"[{index}] Result: {result}")
+            return result
+        except Exception as e:
+            print(f"❌ [{index}] Processing failed after {time.monotonic() - start:.1f}s: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+async def test_orchestrator(pairs=DEFAULT_PAIRS):
+    # Independent submissions overlap their I/O and LLM calls, CONCURRENCY at a time;
+    # each one hands its evaluation through its own raw_things/llama_output_<id>.txt
+    print(f"Testing {len(pairs)} submission(s), {CONCURRENCY} at a time")
+
+    orchestrator = Orchestrator()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    start = time.monotonic()
+    results = await asyncio.gather(*[
+        run_submission(orchestrator, semaphore, index, answer_sheet, question_key)
+        for index, (answer_sheet, question_key) in enumerate(pairs, 1)
+    ])
+    succeeded = sum(result is not None and result.get('status') == 'success' for result in results)
+    print(f"\n{succeeded}/{len(pairs)} submissions succeeded in {time.monotonic() - start:.1f}s total")
+    return results
 
 if __name__ == "__main__":
-    asyncio.run(test_orchestrator())
\ No newline at end of file
+    # Usage: python test_orchestrator.py [answer_sheet question_key]...
+    args = sys.argv[1:]
+    if len(args) % 2:
+        sys.exit("Pass answer sheet / question key paths in pairs")
+    pairs = list(zip(args[::2], args[1::2])) or DEFAULT_PAIRS
+    asyncio.run(test_orchestrator(pairs))